@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import platform
+import sys
+import time
+from math import exp, lgamma, log, sqrt
+from typing import Any, Callable, Iterator
+
+from main import BloomFilter, CountingBloomFilter, BlockedBloomFilter, ScalableBloomFilter, HashScheme, BATCH_SIZE, BLOCK_BITS, batched, np
+from parallel import ShardedBloomFilter
+
+# every backend is built for (capacity, error_rate) and must offer add_many/lookup_many/estimate_dataset_size
+BACKENDS: dict[str, Callable[[int, float], Any]] = {
+    'plain-sha1'  : lambda n, p: BloomFilter.from_capacity(n, p, hash_scheme=HashScheme.SHA1),
+    'plain-double': lambda n, p: BloomFilter.from_capacity(n, p),
+    'counting'    : lambda n, p: CountingBloomFilter.from_capacity(n, p),
+    'blocked'     : lambda n, p: BlockedBloomFilter.from_capacity(n, p),
+    'scalable'    : lambda n, p: ScalableBloomFilter(max(1, n // 16), p),
+    'sharded'     : lambda n, p: ShardedBloomFilter.from_capacity(8, n, p),
+}
+
+def timed(func: Callable[[], object]) -> float:
+    started_at = time.perf_counter()
+    func()
+    return time.perf_counter() - started_at
+
+def run(count: int, size: int, number_hashes: int) -> None:
+    elements = [f"key-{i}" for i in range(count)]
+    probes = [f"probe-{i}" for i in range(count)]
+
+    print(f"keys: {count:,}, size: {size:,} bits, hashes: {number_hashes}, numpy: {np is not None}")
+    print(f"{'scheme':<8} {'method':<12} {'add/s':>14} {'lookup/s':>14}")
+
+    for scheme in HashScheme:
+        loop_filter = BloomFilter(size, number_hashes, hash_scheme=scheme)
+        loop_add = timed(lambda: [loop_filter.add(element) for element in elements])
+        loop_lookup = timed(lambda: [loop_filter.lookup(probe) for probe in probes])
+
+        batch_filter = BloomFilter(size, number_hashes, hash_scheme=scheme)
+        batch_add = timed(lambda: batch_filter.add_many(elements))
+        batch_lookup = timed(lambda: batch_filter.lookup_many(probes))
+
+        assert loop_filter.bit_array == batch_filter.bit_array
+
+        print(f"{scheme.name:<8} {'loop':<12} {count / loop_add:>14,.0f} {count / loop_lookup:>14,.0f}")
+        print(f"{scheme.name:<8} {'batch':<12} {count / batch_add:>14,.0f} {count / batch_lookup:>14,.0f}")
+
+def generate_keys(prefix: str, seed: int, count: int) -> Iterator[str]:
+    return (f"{prefix}-{seed}-{i}" for i in range(count))
+
+def sub_filters(bloom: Any) -> list[BloomFilter]:
+    return bloom.filters if isinstance(bloom, (ScalableBloomFilter, ShardedBloomFilter)) else [bloom]
+
+def blocked_error_rate(number_hashes: int, blocks: int, count: float) -> float:
+    # keys spread over the blocks with a Poisson(n/B) load, a block holding j keys fails a probe
+    # with (1 - (1 - k/b)^j)^k since the k bits of a key are distinct inside its block. Uneven
+    # loads make this higher than the plain formula for the same number of bits. It assumes
+    # random bits inside a block, the arithmetic progression offsets of BlockedBloomFilter
+    # measure a little above it at small error rates
+    load = count / blocks
+    unset = 1 - number_hashes / BLOCK_BITS
+    error_rate = 0.0
+    for keys in range(int(load + 12 * sqrt(load) + 20)):
+        weight = exp(keys * log(load) - load - lgamma(keys + 1)) if load > 0 else float(keys == 0)
+        error_rate += weight * (1 - unset ** keys) ** number_hashes
+
+    return error_rate
+
+def theoretical_error_rate(bloom: Any, count: int) -> float:
+    # (1 - e^(-kn/m))^k per filter (blocked filters use their own model), a scalable filter
+    # fails if any of its filters fails
+    if isinstance(bloom, ScalableBloomFilter):
+        counts = bloom.counts
+    else:
+        counts = [count / len(sub_filters(bloom))] * len(sub_filters(bloom))
+
+    passed = 1.0
+    for sub_filter, sub_count in zip(sub_filters(bloom), counts):
+        k, m = sub_filter.number_hashes, sub_filter.size
+        if isinstance(sub_filter, BlockedBloomFilter):
+            passed *= 1 - blocked_error_rate(k, sub_filter.blocks, sub_count)
+        else:
+            passed *= 1 - (1 - exp(-k * sub_count / m)) ** k
+
+    # sharded filters send each probe to a single shard, the shards are equally loaded
+    return 1 - passed if isinstance(bloom, ScalableBloomFilter) else 1 - passed ** (1 / len(counts))
+
+def measure(name: str, count: int, error_rate: float, seed: int, probe_limit: int) -> dict[str, Any]:
+    bloom = BACKENDS[name](count, error_rate)
+    probe_count = min(count, probe_limit)
+
+    started_at = time.perf_counter()
+    bloom.add_many(generate_keys("key", seed, count))
+    insert_time = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    found = sum(sum(bloom.lookup_many(batch)) for batch in batched(generate_keys("key", seed, count), BATCH_SIZE))
+    lookup_time = time.perf_counter() - started_at
+
+    false_positives = sum(
+        sum(bloom.lookup_many(batch)) for batch in batched(generate_keys("probe", seed, probe_count), BATCH_SIZE)
+    )
+
+    estimate = bloom.estimate_dataset_size()
+    memory = sum(len(sub_filter.bit_array) for sub_filter in sub_filters(bloom))
+
+    return {
+        'backend'               : name,
+        'keys'                  : count,
+        'target_error_rate'     : error_rate,
+        'insert_per_second'     : count / insert_time,
+        'lookup_per_second'     : count / lookup_time,
+        'bytes_per_key'         : memory / count,
+        'false_negatives'       : count - found,
+        'measured_error_rate'   : false_positives / probe_count,
+        'theoretical_error_rate': theoretical_error_rate(bloom, count),
+        'estimated_keys'        : estimate,
+        'estimate_error'        : (estimate - count) / count,
+    }
+
+def run_suite(
+    backends: list[str],
+    min_exponent: int,
+    max_exponent: int,
+    error_rate: float,
+    seed: int,
+    probe_limit: int,
+    json_path: str,
+) -> None:
+    environment = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'numpy': None if np is None else np.__version__,
+        'seed': seed,
+    }
+
+    json_file = None
+    if json_path == '-':
+        json_file = sys.stdout
+    elif json_path:
+        json_file = open(json_path, 'a')
+
+    if json_file is not sys.stdout:
+        print(f"{'backend':<14} {'keys':>12} {'insert/s':>12} {'lookup/s':>12} {'bytes/key':>10} {'fpr':>8} {'theory':>8} {'estimate':>9}")
+
+    try:
+        for exponent in range(min_exponent, max_exponent + 1):
+            for name in backends:
+                result = measure(name, 10 ** exponent, error_rate, seed, probe_limit)
+
+                if json_file is not None:
+                    json_file.write(json.dumps({**environment, **result}) + "\n")
+                    json_file.flush()
+
+                if json_file is not sys.stdout:
+                    print(
+                        f"{name:<14} {result['keys']:>12,} {result['insert_per_second']:>12,.0f} {result['lookup_per_second']:>12,.0f} "
+                        f"{result['bytes_per_key']:>10.2f} {result['measured_error_rate']:>8.4f} "
+                        f"{result['theoretical_error_rate']:>8.4f} {result['estimate_error']:>+9.2%}"
+                    )
+    finally:
+        if json_file is not None and json_file is not sys.stdout:
+            json_file.close()
+
+def run_variants(count: int, error_rate: float) -> None:
+    elements = [f"key-{i}" for i in range(count)]
+    probes = [f"probe-{i}" for i in range(count)]
+
+    print(f"keys: {count:,}, target error rate: {error_rate}")
+    print(f"{'filter':<20} {'lookup/s':>14} {'bytes/key':>10} {'fpr':>8}")
+
+    for filter_class in (BloomFilter, CountingBloomFilter, BlockedBloomFilter):
+        bloom = filter_class.from_capacity(count, error_rate)
+        bloom.add_many(elements)
+
+        started_at = time.perf_counter()
+        hits = sum(bloom.lookup(probe) for probe in probes)
+        lookup_time = time.perf_counter() - started_at
+
+        print(f"{filter_class.__name__:<20} {count / lookup_time:>14,.0f} {len(bloom.bit_array) / count:>10.2f} {hits / count:>8.4f}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='benchmark the bloom filters')
+    parser.add_argument('-n', '--count', type=int, default=100_000, help='how many keys should be inserted [default: 100000]')
+    parser.add_argument('-m', '--size', type=int, default=1_000_000, help='filter size in bits [default: 1000000]')
+    parser.add_argument('-k', '--hashes', type=int, default=7, help='number of hash functions [default: 7]')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.01, help='target error rate of the variants and suite runs [default: 0.01]')
+    parser.add_argument('--variants', action='store_true', default=False, help='compare plain, counting and blocked filters instead')
+    parser.add_argument('--suite', action='store_true', default=False, help='run the throughput and accuracy suite over 10^min..10^max keys instead')
+    parser.add_argument('--backend', action='append', choices=BACKENDS, help='which backend the suite should run [default: all, repeatable]')
+    parser.add_argument('--min-exponent', type=int, default=4, help='smallest suite dataset is 10^min keys [default: 4]')
+    parser.add_argument('--max-exponent', type=int, default=6, help='largest suite dataset is 10^max keys [default: 6, up to 8]')
+    parser.add_argument('--probes', type=int, default=1_000_000, help='max non-member keys probed for the false positive rate [default: 1000000]')
+    parser.add_argument('--seed', type=int, default=0, help='seed mixed into the generated keys [default: 0]')
+    parser.add_argument('--json', default='', help='append one JSON line per result to this file, - for stdout only')
+    args = parser.parse_args()
+
+    if args.suite:
+        run_suite(args.backend or list(BACKENDS), args.min_exponent, args.max_exponent, args.error_rate, args.seed, args.probes, args.json)
+    elif args.variants:
+        run_variants(args.count, args.error_rate)
+    else:
+        run(args.count, args.size, args.hashes)
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,506 @@
 #!/usr/bin/env python
 
-from typing import Self, Optional, Type
-from hashlib import sha1
-from math import log
+from typing import Self, Optional, Callable, Union, Iterable, Iterator
+from hashlib import sha1, blake2b
+from math import log, ceil
+from enum import Enum
+from itertools import islice
+import mmap
+import operator
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Buffer = Union[bytearray, bytes, memoryview]
+
+POPCOUNT_CHUNK_BYTES = 1 << 20
+COMBINE_CHUNK_BYTES = 1 << 20
+BATCH_SIZE = 100_000
+
+MASK_64 = (1 << 64) - 1
+
+# file layout (little-endian)
+#   magic(4) version(u16) hash_scheme(u8) filter_kind(u8) number_hashes(u32) size(u64) salt_length(u32)
+#   salt(utf-8), zero padding up to FILE_ALIGN, then the raw bit (or counter) buffer
+FILE_MAGIC = b"BLMF"
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct("<4sHBBIQI")
+FILE_ALIGN = 64
+FILE_ACCESS = {
+    "r" : mmap.ACCESS_READ,  # shared, read only
+    "r+": mmap.ACCESS_WRITE, # shared, changes are written back to the file
+    "c" : mmap.ACCESS_COPY,  # private copy-on-write, changes stay in this process
+}
+
+# SHA1   : one sha1 digest per hash function (original scheme)
+# DOUBLE : Kirsch-Mitzenmacher, index_i = (h1 + i * h2) mod 2^64 mod size from one blake2b digest
+HashScheme = Enum('HashScheme', 'SHA1 DOUBLE', start=0)
+
+# PLAIN    : one bit per index
+# COUNTING : one 4-bit counter per index, supports remove
+# BLOCKED  : one bit per index, all k bits of an element inside one 64-byte block
+FilterKind = Enum('FilterKind', 'PLAIN COUNTING BLOCKED', start=0)
+
+BLOCK_BITS = 512
+COUNTER_MAX = 15
+NONZERO_NIBBLES = bytes((value & 15 != 0) + (value >> 4 != 0) for value in range(256))
 
 class BloomFilter:
-    def __init__(self: Self, size: int, number_hashes: int, salt: Optional[str] = None) -> None:
+    # bits are packed 8 per byte, bit `i` lives in byte `i >> 3` at position `i & 7`
+    kind = FilterKind.PLAIN
+
+    def __init__(
+        self: Self,
+        size: int,
+        number_hashes: int,
+        salt: Optional[str] = None,
+        hash_scheme: HashScheme = HashScheme.SHA1,
+        bit_array: Optional[Buffer] = None,
+    ) -> None:
         self.size = size
         self.number_hashes = number_hashes
         self.salt = "" if salt is None else salt
-        self.bit_array = [0] * size
+        self.hash_scheme = hash_scheme
+        self.bit_array = bytearray(self.buffer_size(size)) if bit_array is None else bit_array
+        self.mapped_file: Optional[mmap.mmap] = None
 
-    def add(self: Self, element: str) -> None:
-        for i in range(self.number_hashes):
-            digest = sha1(f"{self.salt}{element}{i}".encode("utf-8")).hexdigest()
-            index = int(digest, 16) % self.size
+    def __enter__(self: Self) -> Self:
+        return self
 
-            self.bit_array[index] = 1
+    def __exit__(self: Self, *args) -> None:
+        self.close()
 
-    def lookup(self: Self, element: str) -> bool:
+    @classmethod
+    def from_capacity(
+        cls,
+        capacity: int,
+        error_rate: float,
+        salt: Optional[str] = None,
+        hash_scheme: HashScheme = HashScheme.DOUBLE,
+    ) -> Self:
+        # optimal m = -n ln(p) / ln(2)^2 bits and k = (m / n) ln(2) hashes
+        size = ceil(-capacity * log(error_rate) / log(2) ** 2)
+        number_hashes = max(1, round(size / capacity * log(2)))
+
+        return cls(size, number_hashes, salt, hash_scheme)
+
+    @classmethod
+    def buffer_size(cls, size: int) -> int:
+        return (size + 7) // 8
+
+    @staticmethod
+    def header_size(salt: bytes) -> int:
+        header_size = FILE_HEADER.size + len(salt)
+        return header_size + (-header_size % FILE_ALIGN)
+
+    def save(self: Self, path: str) -> None:
+        salt = self.salt.encode("utf-8")
+        header = FILE_HEADER.pack(
+            FILE_MAGIC, FILE_VERSION, self.hash_scheme.value, self.kind.value, self.number_hashes, self.size, len(salt)
+        ) + salt
+
+        with open(path, "wb") as f:
+            f.write(header.ljust(self.header_size(salt), b"\0"))
+            f.write(self.bit_array)
+
+    @classmethod
+    def open(cls, path: str, mode: str = "r") -> Self:
+        if mode not in FILE_ACCESS:
+            raise ValueError(f"Unknown open mode: {mode}, expected one of {', '.join(FILE_ACCESS)}")
+
+        # a copy-on-write map never writes back, so only "r+" needs a writable file
+        with open(path, "r+b" if mode == "r+" else "rb") as f:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=FILE_ACCESS[mode])
+
+        try:
+            magic, version, scheme, kind, number_hashes, size, salt_length = FILE_HEADER.unpack_from(mapped_file)
+            if magic != FILE_MAGIC:
+                raise ValueError(f"Not a bloom filter file: {path}")
+            if version != FILE_VERSION:
+                raise ValueError(f"Unsupported bloom filter file version: {version}")
+
+            # BloomFilter.open returns whichever variant was saved, a variant only opens its own files
+            filter_class = FILTER_CLASSES[FilterKind(kind)]
+            if not issubclass(filter_class, cls):
+                raise ValueError(f"Cannot open {filter_class.__name__} file as {cls.__name__}: {path}")
+
+            salt = mapped_file[FILE_HEADER.size:FILE_HEADER.size + salt_length]
+            offset = cls.header_size(salt)
+            if len(mapped_file) != offset + filter_class.buffer_size(size):
+                raise ValueError(f"Truncated bloom filter file: {path}")
+        except Exception:
+            mapped_file.close()
+            raise
+
+        # lookups read straight from the page cache, no copy of the bits is made
+        bit_array = memoryview(mapped_file)[offset:]
+        bloom = filter_class(size, number_hashes, salt.decode("utf-8"), HashScheme(scheme), bit_array)
+        bloom.mapped_file = mapped_file
+
+        return bloom
+
+    def close(self: Self) -> None:
+        if self.mapped_file is None:
+            return
+
+        self.mapped_file.flush()
+        self.bit_array.release()
+        self.mapped_file.close()
+        self.mapped_file = None
+
+    def hash_pair(self: Self, element: str) -> tuple[int, int]:
+        digest = blake2b(f"{self.salt}{element}".encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1 # odd step, never stuck on one index
+
+        return h1, h2
+
+    def indexes(self: Self, element: str) -> list[int]:
+        if self.hash_scheme is HashScheme.DOUBLE:
+            h1, h2 = self.hash_pair(element)
+            return [((h1 + i * h2) & MASK_64) % self.size for i in range(self.number_hashes)]
+
+        indexes = []
         for i in range(self.number_hashes):
             digest = sha1(f"{self.salt}{element}{i}".encode("utf-8")).hexdigest()
-            index = int(digest, 16) % self.size
+            indexes.append(int(digest, 16) % self.size)
+
+        return indexes
+
+    def add(self: Self, element: str) -> None:
+        for index in self.indexes(element):
+            self.bit_array[index >> 3] |= 1 << (index & 7)
 
-            if self.bit_array[index] == 0:
+    def lookup(self: Self, element: str) -> bool:
+        for index in self.indexes(element):
+            if not self.bit_array[index >> 3] & (1 << (index & 7)):
                 return False
 
         return True
 
+    def index_matrix(self: Self, elements: list[str]) -> "np.ndarray":
+        # (len(elements), number_hashes) matrix of bit indexes, same values as `indexes`
+        if self.hash_scheme is HashScheme.DOUBLE:
+            pairs = np.array([self.hash_pair(element) for element in elements], dtype=np.uint64).reshape(-1, 2)
+            steps = np.arange(self.number_hashes, dtype=np.uint64)
+
+            # uint64 arithmetic wraps around, which is the `& MASK_64` of the scalar path
+            return (pairs[:, :1] + steps * pairs[:, 1:]) % np.uint64(self.size)
+
+        return np.array([self.indexes(element) for element in elements], dtype=np.uint64).reshape(-1, self.number_hashes)
+
+    def vectorized(self: Self) -> bool:
+        # sha1 indexes are 160-bit ints, numpy only pays off for the 64-bit double hashing
+        return np is not None and self.hash_scheme is HashScheme.DOUBLE
+
+    def add_many(self: Self, elements: Iterable[str]) -> None:
+        if not self.vectorized():
+            for element in elements:
+                self.add(element)
+            return
+
+        # `.at` does not check the flag, writing to a filter opened with mode "r" would crash numpy
+        bit_view = np.frombuffer(self.bit_array, dtype=np.uint8)
+        if not bit_view.flags.writeable:
+            raise TypeError("Cannot add to a bloom filter opened read-only")
+
+        for batch in batched(elements, BATCH_SIZE):
+            indexes = self.index_matrix(batch).ravel()
+            masks = np.left_shift(1, indexes & np.uint64(7)).astype(np.uint8)
+
+            # `.at` applies repeated byte positions one after another instead of keeping only the last
+            np.bitwise_or.at(bit_view, indexes >> np.uint64(3), masks)
+
+    def lookup_many_array(self: Self, elements: Iterable[str]) -> "np.ndarray":
+        if np is None:
+            raise RuntimeError("lookup_many_array requires numpy")
+
+        buffer_view = np.frombuffer(self.bit_array, dtype=np.uint8)
+        results = [np.zeros(0, dtype=bool)]
+        for batch in batched(elements, BATCH_SIZE):
+            results.append(self.test_matrix(buffer_view, self.index_matrix(batch)).all(axis=1))
+
+        return np.concatenate(results)
+
+    def test_matrix(self: Self, buffer_view: "np.ndarray", indexes: "np.ndarray") -> "np.ndarray":
+        return (buffer_view[indexes >> np.uint64(3)] >> (indexes & np.uint64(7)).astype(np.uint8)) & 1 == 1
+
+    def lookup_many(self: Self, elements: Iterable[str]) -> list[bool]:
+        if not self.vectorized():
+            return [self.lookup(element) for element in elements]
+
+        return self.lookup_many_array(elements).tolist()
+
+    def count_bits(self: Self) -> int:
+        # popcount in 1 MiB slices, avoids building one huge int for large filters
+        view = memoryview(self.bit_array)
+        total = 0
+        for offset in range(0, len(view), POPCOUNT_CHUNK_BYTES):
+            total += int.from_bytes(view[offset:offset + POPCOUNT_CHUNK_BYTES], "little").bit_count()
+
+        return total
+
+    def bits(self: Self) -> list[int]:
+        return [(self.bit_array[i >> 3] >> (i & 7)) & 1 for i in range(self.size)]
+
     def estimate_dataset_size(self: Self) -> float:
         m = self.size
         k = self.number_hashes
-        n = -(m / k) * log(1 - sum(self.bit_array) / m)
+        n = -(m / k) * log(1 - self.count_bits() / m)
 
         return n
 
-    def union(self: Self, other: Self) -> Self:
+    def copy(self: Self) -> Self:
+        return type(self)(self.size, self.number_hashes, self.salt, self.hash_scheme, bytearray(self.bit_array))
+
+    def check_compatible(self: Self, other: Self) -> None:
+        if self.kind is not other.kind:
+            raise ValueError("Both filters must be the same kind of filter")
+
         if self.size != other.size or self.number_hashes != other.number_hashes:
             raise ValueError("Both filters must have the same size and hash count")
 
-        result = BloomFilter(self.size, self.number_hashes)
-        result.bit_array = [x | y for x, y in zip(self.bit_array, other.bit_array)]
+        if self.hash_scheme is not other.hash_scheme or self.salt != other.salt:
+            raise ValueError("Both filters must have the same hash scheme and salt")
 
-        return result
+    def union(self: Self, other: Self) -> Self:
+        self.check_compatible(other)
+
+        bit_array = combine_buffers(self.bit_array, other.bit_array, operator.or_)
+        return type(self)(self.size, self.number_hashes, self.salt, self.hash_scheme, bit_array)
 
     def intersection(self: Self, other: Self) -> Self:
-        if self.size != other.size or self.number_hashes != other.number_hashes:
-            raise ValueError("Both filters must have the same size and hash count")
+        self.check_compatible(other)
 
-        result = BloomFilter(self.size, self.number_hashes)
-        result.bit_array = [x & y for x, y in zip(self.bit_array, other.bit_array)]
+        bit_array = combine_buffers(self.bit_array, other.bit_array, operator.and_)
+        return type(self)(self.size, self.number_hashes, self.salt, self.hash_scheme, bit_array)
+
+class CountingBloomFilter(BloomFilter):
+    # 4-bit counters packed 2 per byte, counter `i` lives in byte `i >> 1`, low nibble for even `i`
+    kind = FilterKind.COUNTING
+
+    @classmethod
+    def buffer_size(cls, size: int) -> int:
+        return (size + 1) // 2
+
+    def counter(self: Self, index: int) -> int:
+        return (self.bit_array[index >> 1] >> ((index & 1) << 2)) & COUNTER_MAX
+
+    def add(self: Self, element: str) -> None:
+        for index in self.indexes(element):
+            # a saturated counter stays at the maximum, its true value is unknown from now on
+            if self.counter(index) < COUNTER_MAX:
+                self.bit_array[index >> 1] += 1 << ((index & 1) << 2)
+
+    def add_many(self: Self, elements: Iterable[str]) -> None:
+        # numpy has no saturating nibble add, counters are updated one element at a time
+        for element in elements:
+            self.add(element)
+
+    def remove(self: Self, element: str) -> None:
+        if not self.lookup(element):
+            raise ValueError("Cannot remove an element which is not in the filter")
+
+        for index in self.indexes(element):
+            if self.counter(index) < COUNTER_MAX:
+                self.bit_array[index >> 1] -= 1 << ((index & 1) << 2)
+
+    def lookup(self: Self, element: str) -> bool:
+        for index in self.indexes(element):
+            if self.counter(index) == 0:
+                return False
+
+        return True
+
+    def test_matrix(self: Self, buffer_view: "np.ndarray", indexes: "np.ndarray") -> "np.ndarray":
+        shifts = ((indexes & np.uint64(1)) << np.uint64(2)).astype(np.uint8)
+        return (buffer_view[indexes >> np.uint64(1)] >> shifts) & COUNTER_MAX != 0
+
+    def count_bits(self: Self) -> int:
+        # number of non-zero counters, so estimate_dataset_size works unchanged
+        view = memoryview(self.bit_array)
+        total = 0
+        for offset in range(0, len(view), POPCOUNT_CHUNK_BYTES):
+            nonzero = bytes(view[offset:offset + POPCOUNT_CHUNK_BYTES]).translate(NONZERO_NIBBLES)
+            total += nonzero.count(1) + 2 * nonzero.count(2)
+
+        return total
+
+    def bits(self: Self) -> list[int]:
+        return [self.counter(i) for i in range(self.size)]
+
+    def union(self: Self, other: Self) -> Self:
+        self.check_compatible(other)
+
+        bit_array = combine_counters(self.bit_array, other.bit_array, lambda x, y: min(x + y, COUNTER_MAX))
+        return type(self)(self.size, self.number_hashes, self.salt, self.hash_scheme, bit_array)
+
+    def intersection(self: Self, other: Self) -> Self:
+        self.check_compatible(other)
+
+        bit_array = combine_counters(self.bit_array, other.bit_array, min)
+        return type(self)(self.size, self.number_hashes, self.salt, self.hash_scheme, bit_array)
+
+class BlockedBloomFilter(BloomFilter):
+    # size is rounded up to whole 512-bit blocks (one 64-byte cache line), an element picks one
+    # block from h1 and sets all k bits inside it, so a lookup touches a single cache line
+    kind = FilterKind.BLOCKED
+
+    def __init__(
+        self: Self,
+        size: int,
+        number_hashes: int,
+        salt: Optional[str] = None,
+        hash_scheme: HashScheme = HashScheme.DOUBLE,
+        bit_array: Optional[Buffer] = None,
+    ) -> None:
+        if hash_scheme is not HashScheme.DOUBLE:
+            raise ValueError("Blocked filter requires the double hashing scheme")
+
+        super().__init__(-(-size // BLOCK_BITS) * BLOCK_BITS, number_hashes, salt, hash_scheme, bit_array)
+        self.blocks = self.size // BLOCK_BITS
+
+    def indexes(self: Self, element: str) -> list[int]:
+        h1, h2 = self.hash_pair(element)
+        base = (h1 % self.blocks) * BLOCK_BITS
+
+        # h2 is odd, so the offsets inside the block do not repeat for the first 512 hashes
+        return [base + (((h2 >> 9) + i * h2) & (BLOCK_BITS - 1)) for i in range(self.number_hashes)]
+
+    def index_matrix(self: Self, elements: list[str]) -> "np.ndarray":
+        pairs = np.array([self.hash_pair(element) for element in elements], dtype=np.uint64).reshape(-1, 2)
+        steps = np.arange(self.number_hashes, dtype=np.uint64)
+        bases = (pairs[:, :1] % np.uint64(self.blocks)) * np.uint64(BLOCK_BITS)
+
+        return bases + (((pairs[:, 1:] >> np.uint64(9)) + steps * pairs[:, 1:]) & np.uint64(BLOCK_BITS - 1))
+
+FILTER_CLASSES = {
+    FilterKind.PLAIN   : BloomFilter,
+    FilterKind.COUNTING: CountingBloomFilter,
+    FilterKind.BLOCKED : BlockedBloomFilter,
+}
+
+class ScalableBloomFilter:
+    # chain of sub-filters, filter i holds initial_capacity * growth_factor^i elements at
+    # error_rate * (1 - tightening_ratio) * tightening_ratio^i, so the total stays under error_rate
+    def __init__(
+        self: Self,
+        initial_capacity: int,
+        error_rate: float,
+        growth_factor: int = 2,
+        tightening_ratio: float = 0.85,
+        salt: Optional[str] = None,
+        hash_scheme: HashScheme = HashScheme.DOUBLE,
+    ) -> None:
+        if not 0 < error_rate < 1:
+            raise ValueError("Error rate must be between 0 and 1")
+
+        if not 0 < tightening_ratio < 1:
+            raise ValueError("Tightening ratio must be between 0 and 1")
+
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth_factor = growth_factor
+        self.tightening_ratio = tightening_ratio
+        self.salt = "" if salt is None else salt
+        self.hash_scheme = hash_scheme
+        self.filters: list[BloomFilter] = []
+        self.counts: list[int] = []
+
+    def __len__(self: Self) -> int:
+        return sum(self.counts)
+
+    def capacity_at(self: Self, level: int) -> int:
+        return self.initial_capacity * self.growth_factor ** level
+
+    def error_rate_at(self: Self, level: int) -> float:
+        return self.error_rate * (1 - self.tightening_ratio) * self.tightening_ratio ** level
+
+    def new_filter(self: Self, level: int) -> BloomFilter:
+        return BloomFilter.from_capacity(self.capacity_at(level), self.error_rate_at(level), self.salt, self.hash_scheme)
+
+    def add(self: Self, element: str) -> None:
+        # an element already (probably) present would only burn capacity of the current filter
+        if self.lookup(element):
+            return
+
+        level = len(self.filters) - 1
+        if level < 0 or self.counts[level] >= self.capacity_at(level):
+            level += 1
+            self.filters.append(self.new_filter(level))
+            self.counts.append(0)
+
+        self.filters[level].add(element)
+        self.counts[level] += 1
+
+    def add_many(self: Self, elements: Iterable[str]) -> None:
+        for element in elements:
+            self.add(element)
+
+    def lookup(self: Self, element: str) -> bool:
+        # newest filter is the largest, most recent keys are found there first
+        return any(bloom.lookup(element) for bloom in reversed(self.filters))
+
+    def lookup_many(self: Self, elements: Iterable[str]) -> list[bool]:
+        elements = list(elements)
+        results = [False] * len(elements)
+        for bloom in self.filters:
+            results = [found or hit for found, hit in zip(results, bloom.lookup_many(elements))]
+
+        return results
+
+    def estimate_dataset_size(self: Self) -> float:
+        return sum(bloom.estimate_dataset_size() for bloom in self.filters)
+
+    def union(self: Self, other: Self) -> Self:
+        parameters = (self.initial_capacity, self.error_rate, self.growth_factor, self.tightening_ratio, self.salt, self.hash_scheme)
+        if parameters != (other.initial_capacity, other.error_rate, other.growth_factor, other.tightening_ratio, other.salt, other.hash_scheme):
+            raise ValueError("Both filters must have the same capacity, error rate, growth and hash parameters")
+
+        # same parameters give the same sub-filter shape on every level, merge level by level
+        result = ScalableBloomFilter(*parameters)
+        for level in range(max(len(self.filters), len(other.filters))):
+            if level >= len(self.filters):
+                bloom, count = other.filters[level].copy(), other.counts[level]
+            elif level >= len(other.filters):
+                bloom, count = self.filters[level].copy(), self.counts[level]
+            else:
+                bloom = self.filters[level].union(other.filters[level])
+                count = self.counts[level] + other.counts[level]
+
+            result.filters.append(bloom)
+            result.counts.append(count)
 
         return result
 
+def batched(elements: Iterable[str], size: int) -> Iterator[list[str]]:
+    iterator = iter(elements)
+    while (batch := list(islice(iterator, size))):
+        yield batch
+
+def combine_counters(first: Buffer, second: Buffer, op: Callable[[int, int], int]) -> bytearray:
+    result = bytearray(len(first))
+    for i, (x, y) in enumerate(zip(first, second)):
+        result[i] = op(x & COUNTER_MAX, y & COUNTER_MAX) | op(x >> 4, y >> 4) << 4
+
+    return result
+
+def combine_buffers(first: Buffer, second: Buffer, op: Callable[[int, int], int]) -> bytearray:
+    # apply `op` on whole slices of both buffers at once instead of bit by bit
+    first_view = memoryview(first)
+    second_view = memoryview(second)
+    result = bytearray(len(first_view))
+    for offset in range(0, len(first_view), COMBINE_CHUNK_BYTES):
+        first_chunk = first_view[offset:offset + COMBINE_CHUNK_BYTES]
+        second_chunk = second_view[offset:offset + COMBINE_CHUNK_BYTES]
+        value = op(int.from_bytes(first_chunk, "little"), int.from_bytes(second_chunk, "little"))
+        result[offset:offset + len(first_chunk)] = value.to_bytes(len(first_chunk), "little")
+
+    return result
+
 def main() -> None:
     coffees = [
         "Iced Coffee",
@@ -68,7 +516,7 @@ def main() -> None:
     bloom = BloomFilter(20, 2)
     for drink in coffees:
         bloom.add(drink)
-        print(bloom.bit_array)
+        print(bloom.bits())
 
     print("---Experiment #1---")
     print(bloom.lookup("Flat White"))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import time
+from concurrent import futures
+from math import ceil
+from multiprocessing import shared_memory
+from typing import Self, Optional, Iterable, Sequence
+from zlib import crc32
+
+from main import BloomFilter, HashScheme
+
+def build_partial(
+    memory_name: str,
+    size: int,
+    number_hashes: int,
+    salt: str,
+    hash_scheme: int,
+    elements: Sequence[str],
+) -> None:
+    # runs in a worker process, fills the shared buffer created by the parent
+    memory = shared_memory.SharedMemory(name=memory_name)
+    bit_array = memory.buf[:BloomFilter.buffer_size(size)]
+
+    try:
+        BloomFilter(size, number_hashes, salt, HashScheme(hash_scheme), bit_array).add_many(elements)
+    finally:
+        bit_array.release()
+        memory.close()
+
+def build_parallel(
+    elements: Sequence[str],
+    size: int,
+    number_hashes: int,
+    salt: Optional[str] = None,
+    hash_scheme: HashScheme = HashScheme.DOUBLE,
+    workers: Optional[int] = None,
+) -> BloomFilter:
+    workers = workers or os.cpu_count() or 1
+    salt = "" if salt is None else salt
+    buffer_size = BloomFilter.buffer_size(size)
+    step = ceil(len(elements) / workers) or 1
+
+    # one shared buffer per worker, so no two processes ever write the same byte
+    memories = [shared_memory.SharedMemory(create=True, size=buffer_size) for _ in range(workers)]
+    try:
+        with futures.ProcessPoolExecutor(workers) as executor:
+            tasks = []
+            for memory, start in zip(memories, range(0, len(elements), step)):
+                tasks.append(executor.submit(
+                    build_partial, memory.name, size, number_hashes, salt, hash_scheme.value, elements[start:start + step]
+                ))
+
+            for task in tasks:
+                task.result()
+
+        result = BloomFilter(size, number_hashes, salt, hash_scheme)
+        for memory in memories:
+            bit_array = memory.buf[:buffer_size]
+            result = result.union(BloomFilter(size, number_hashes, salt, hash_scheme, bit_array))
+            bit_array.release()
+
+        return result
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+
+class ShardedBloomFilter:
+    # keys are routed by crc32 to one of N independent filters with the same parameters, every
+    # shard has its own lock for writers, lookups only read and never take a lock
+    def __init__(
+        self: Self,
+        shards: int,
+        size: int,
+        number_hashes: int,
+        salt: Optional[str] = None,
+        hash_scheme: HashScheme = HashScheme.DOUBLE,
+    ) -> None:
+        self.filters = [BloomFilter(size, number_hashes, salt, hash_scheme) for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    @classmethod
+    def from_capacity(
+        cls,
+        shards: int,
+        capacity: int,
+        error_rate: float,
+        salt: Optional[str] = None,
+        hash_scheme: HashScheme = HashScheme.DOUBLE,
+    ) -> Self:
+        bloom = BloomFilter.from_capacity(ceil(capacity / shards), error_rate)
+        return cls(shards, bloom.size, bloom.number_hashes, salt, hash_scheme)
+
+    def shard_of(self: Self, element: str) -> int:
+        return crc32(element.encode("utf-8")) % len(self.filters)
+
+    def group(self: Self, elements: Iterable[str]) -> list[list[tuple[int, str]]]:
+        groups: list[list[tuple[int, str]]] = [[] for _ in self.filters]
+        for position, element in enumerate(elements):
+            groups[self.shard_of(element)].append((position, element))
+
+        return groups
+
+    def add(self: Self, element: str) -> None:
+        shard = self.shard_of(element)
+        with self.locks[shard]:
+            self.filters[shard].add(element)
+
+    def add_many(self: Self, elements: Iterable[str]) -> None:
+        for shard, group in enumerate(self.group(elements)):
+            with self.locks[shard]:
+                self.filters[shard].add_many(element for _, element in group)
+
+    def lookup(self: Self, element: str) -> bool:
+        return self.filters[self.shard_of(element)].lookup(element)
+
+    def lookup_many(self: Self, elements: Iterable[str]) -> list[bool]:
+        groups = self.group(elements)
+        results = [False] * sum(len(group) for group in groups)
+        for bloom, group in zip(self.filters, groups):
+            for (position, _), found in zip(group, bloom.lookup_many(element for _, element in group)):
+                results[position] = found
+
+        return results
+
+    def estimate_dataset_size(self: Self) -> float:
+        return sum(bloom.estimate_dataset_size() for bloom in self.filters)
+
+    def union(self: Self, other: Self) -> Self:
+        if len(self.filters) != len(other.filters):
+            raise ValueError("Both filters must have the same number of shards")
+
+        first = self.filters[0]
+        result = ShardedBloomFilter(len(self.filters), first.size, first.number_hashes, first.salt, first.hash_scheme)
+        result.filters = [bloom.union(other_bloom) for bloom, other_bloom in zip(self.filters, other.filters)]
+
+        return result
+
+def main() -> None:
+    elements = [f"key-{i}" for i in range(1_000_000)]
+    size, number_hashes = 10_000_000, 7
+
+    started_at = time.perf_counter()
+    single = BloomFilter(size, number_hashes, hash_scheme=HashScheme.DOUBLE)
+    single.add_many(elements)
+    print(f"single process : {time.perf_counter() - started_at:.2f}s")
+
+    started_at = time.perf_counter()
+    parallel = build_parallel(elements, size, number_hashes)
+    print(f"process pool   : {time.perf_counter() - started_at:.2f}s ({os.cpu_count()} workers)")
+
+    assert single.bit_array == parallel.bit_array
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import time
+from collections import deque
+from concurrent import futures
+from typing import Iterator, NamedTuple
+
+MAX_ROW = 1_000
+CHUNK_ROW = 100_000
+BATCH_ROW = 1_000 # rows per insert statement in the insert-batch format
+BUFFER_BYTES = 16 << 20
+
+FORMATS = ('insert', 'insert-batch', 'csv', 'copy')
+
+class Options(NamedTuple):
+    format: str
+    table: str
+    batch_rows: int
+
+def render_rows(start: int, end: int, options: Options) -> bytes:
+    # the rows of one chunk share a timestamp, every row is "id" followed by the same suffix, so
+    # a chunk is one str.join over the ids instead of one f-string per row
+    ids = map(str, range(start, end))
+    micro_time = int(time.time() * 1_000_000)
+
+    if options.format == 'insert':
+        prefix = f"insert into {options.table} (id, a, b, t) values ("
+        suffix = f", 1, 2, {micro_time});\n"
+        text = prefix + (suffix + prefix).join(ids) + suffix
+    elif options.format == 'insert-batch':
+        prefix = f"insert into {options.table} (id, a, b, t) values ("
+        suffix = f",1,2,{micro_time})"
+        statements = []
+        for batch_start in range(start, end, options.batch_rows):
+            batch_ids = map(str, range(batch_start, min(batch_start + options.batch_rows, end)))
+            statements.append(prefix + (suffix + ",(").join(batch_ids) + suffix + ";\n")
+        text = ''.join(statements)
+    elif options.format == 'csv':
+        suffix = f",1,2,{micro_time}\n"
+        text = suffix.join(ids) + suffix
+    else:
+        suffix = f"\t1\t2\t{micro_time}\n"
+        text = suffix.join(ids) + suffix
+
+    return text.encode('ascii')
+
+def render_header(options: Options) -> bytes:
+    if options.format == 'csv':
+        return b"id,a,b,t\n"
+    if options.format == 'copy':
+        return f"COPY {options.table} (id, a, b, t) FROM stdin;\n".encode('ascii')
+    return b""
+
+def render_footer(options: Options) -> bytes:
+    return b"\\.\n" if options.format == 'copy' else b""
+
+class BufferedWriter:
+    # rows are copied into one preallocated buffer which is written out whenever the next chunk
+    # does not fit, so memory stays at the buffer plus one chunk however many rows are written
+    def __init__(self, file, size: int):
+        self.file = file
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.used = 0
+        self.written = 0
+
+    def write(self, data: bytes) -> None:
+        if self.used + len(data) > len(self.buffer):
+            self.flush()
+        if len(data) > len(self.buffer):
+            self.write_all(data)
+            return
+
+        self.view[self.used:self.used + len(data)] = data
+        self.used += len(data)
+
+    def flush(self) -> None:
+        if self.used:
+            self.write_all(self.view[:self.used])
+            self.used = 0
+
+    def write_all(self, data) -> None:
+        # the file is unbuffered, one write can take only part of the data (linux stops at
+        # about 2 GiB per call), so write the rest until nothing is left
+        view = memoryview(data)
+        while view:
+            length = self.file.write(view)
+            self.written += length
+            view = view[length:]
+
+def chunk_ranges(rows: int, chunk_rows: int) -> Iterator[tuple[int, int]]:
+    for i in range(0, rows, chunk_rows):
+        yield i, min(i + chunk_rows, rows)
+
+def render_chunks(rows: int, chunk_rows: int, options: Options, processes: int) -> Iterator[bytes]:
+    # the chunks in id order. With more than one process the chunks are rendered by a pool and
+    # collected in the order they were submitted, at most two per process are in flight so the
+    # finished ones waiting for an earlier chunk do not pile up in memory
+    if processes <= 1:
+        for start, end in chunk_ranges(rows, chunk_rows):
+            yield render_rows(start, end, options)
+        return
+
+    with futures.ProcessPoolExecutor(processes) as executor:
+        pending = deque()
+        for start, end in chunk_ranges(rows, chunk_rows):
+            pending.append(executor.submit(render_rows, start, end, options))
+            if len(pending) >= processes * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def generate(path: str, rows: int, chunk_rows: int, buffer_bytes: int, options: Options, processes: int = 1) -> int:
+    # returns the bytes written
+    with open(path, 'wb', buffering=0) as file:
+        writer = BufferedWriter(file, buffer_bytes)
+        writer.write(render_header(options))
+        for chunk in render_chunks(rows, chunk_rows, options, processes):
+            writer.write(chunk)
+        writer.write(render_footer(options))
+        writer.flush()
+
+    return writer.written
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='create large rows')
+    parser.add_argument('-n', '--rows', type=int, default=MAX_ROW, help=f'how many rows should be created [default: {MAX_ROW:_}]')
+    parser.add_argument('-f', '--format', choices=FORMATS, default='insert', help='insert statement per row, insert statements of --batch-rows rows, csv or postgres copy [default: insert]')
+    parser.add_argument('-o', '--output', default='./insert4.txt', help='output file [default: ./insert4.txt]')
+    parser.add_argument('--table', default='table', help='table name [default: table]')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROW, help=f'rows rendered at once [default: {CHUNK_ROW:_}]')
+    parser.add_argument('--batch-rows', type=int, default=BATCH_ROW, help=f'rows per insert-batch statement [default: {BATCH_ROW:_}]')
+    parser.add_argument('-p', '--processes', type=int, default=os.cpu_count(), help='how many processes render the chunks, 1 renders them in this process [default: cpu count]')
+    parser.add_argument('--buffer-mb', type=int, default=BUFFER_BYTES >> 20, help=f'write buffer size in MiB [default: {BUFFER_BYTES >> 20}]')
+
+    args = parser.parse_args()
+
+    if args.rows < 0 or args.chunk_rows < 1 or args.batch_rows < 1 or args.buffer_mb < 1 or args.processes < 1:
+        parser.error('--rows should not be negative, --chunk-rows, --batch-rows, --buffer-mb and --processes should be positive')
+
+    # a chunk holds whole insert statements so the statement size does not depend on --chunk-rows
+    chunk_rows = args.chunk_rows
+    if args.format == 'insert-batch':
+        chunk_rows = max(args.batch_rows, chunk_rows // args.batch_rows * args.batch_rows)
+
+    print('Gen ...')
+
+    started_at = time.perf_counter()
+    options = Options(args.format, args.table, args.batch_rows)
+    written = generate(args.output, args.rows, chunk_rows, args.buffer_mb << 20, options, args.processes)
+    seconds = time.perf_counter() - started_at
+
+    print(f"{args.rows:,} rows, {written / (1 << 20):,.1f} MiB in {seconds:.2f}s ({args.rows / max(seconds, 1e-9):,.0f} rows/s) to {os.path.abspath(args.output)}")
+
+if __name__ == "__main__":
+    main()
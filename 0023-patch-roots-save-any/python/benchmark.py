@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Callable
+from kind import Entity, Quality
+from main import SAVE_FILES, get_latest_save_file, read_save_timestamp
+
+def create_save(file_path: str, count: int, timestamp: int, timestamp_last: bool) -> None:
+    # a save shaped like the game ones: a few top level keys and a large Entities array
+    entities = []
+    for i in range(count):
+        entities.append({
+            'Type': random.choice((Entity.Plant.value, Entity.Tree.value, Entity.Resource.value, Entity.StorageBox.value)),
+            'ID'  : f"entity-{i}",
+            'Slots': [
+                {'ItemWithProperties': {'Id': j, 'Quality': Quality.Normal.value}, 'SyncedQ': 1} for j in range(4)
+            ],
+        })
+
+    save_object = {'Version': 1, 'Entities': entities}
+    if timestamp_last:
+        save_object['Timestamp'] = timestamp
+    else:
+        save_object = {'Timestamp': timestamp, **save_object}
+
+    with open(file_path, 'w') as f:
+        f.write(json.dumps(save_object, separators=(',', ':')))
+
+def get_latest_save_file_full(config: dict) -> str:
+    # the previous auto find: parse every save in turn
+    timestamps = {save_file: read_save_timestamp(os.path.join(config['save_path'], save_file)) for save_file in SAVE_FILES}
+    return max(SAVE_FILES, key=lambda save_file: timestamps[save_file])
+
+def timed(func: Callable[[], object], repeat: int) -> tuple[float, object]:
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started_at)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the auto find of the latest save')
+    parser.add_argument('-n', '--count', type=int, default=200_000, help='how many entities each save should have [default: 200000]')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='how many runs, the best one is reported [default: 3]')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as save_path:
+        config = {'save_path': save_path}
+
+        for timestamp_last in (False, True):
+            for offset, save_file in enumerate(SAVE_FILES):
+                create_save(os.path.join(save_path, save_file), args.count, 1_700_000_000_000 + offset, timestamp_last)
+
+            size = sum(os.path.getsize(os.path.join(save_path, save_file)) for save_file in SAVE_FILES)
+            full_time, full_result = timed(lambda: get_latest_save_file_full(config), args.repeat)
+            probe_time, probe_result = timed(lambda: get_latest_save_file(config), args.repeat)
+            assert full_result == probe_result
+
+            layout = 'Timestamp after Entities' if timestamp_last else 'Timestamp first'
+            print(f"{layout} ({size / (1 << 20):,.1f} MiB in {len(SAVE_FILES)} saves)")
+            print(f"---- full parse : {full_time * 1000:10.1f} ms")
+            print(f"---- probe      : {probe_time * 1000:10.1f} ms")
+
+if __name__ == "__main__":
+    main()
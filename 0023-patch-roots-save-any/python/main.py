@@ -3,23 +3,56 @@
 import argparse
 import json
 import os
+import sys
+import tempfile
+import time
+from concurrent import futures
 from datetime import datetime, timedelta
+from typing import Iterator, Optional, TextIO
 from kind import Quality, Entity
+from rules import Rule, RulePatcher, load_rules, parse_rule
+from stream import JsonStream, probe_key, value_spans
+
+SAVE_FILES = ('save.json', 'save-int.json', 'save-prev.json')
+PROBE_CHARS = 64 << 10 # the top level keys in front of Entities fit in here
+
+def read_save_timestamp(file_path: str) -> int:
+    file_handler = open(file_path, 'r')
+    save_object = json.loads(file_handler.read())
+    file_handler.close()
+
+    return save_object['Timestamp']
+
+def probe_save_timestamp(file_path: str) -> Optional[int]:
+    # only the start of the save is read, None when Timestamp is not found there
+    with open(file_path, 'r') as f:
+        return probe_key(f.read(PROBE_CHARS), 'Timestamp')
+
+def read_save_timestamps(file_paths: list) -> list:
+    # probes are mostly waiting on the disk so they share threads, the saves that need a full
+    # parse are parsed in processes since json.loads holds the GIL
+    with futures.ThreadPoolExecutor(len(file_paths)) as executor:
+        save_timestamps = list(executor.map(probe_save_timestamp, file_paths))
+
+    missing = [i for i, save_timestamp in enumerate(save_timestamps) if save_timestamp is None]
+    if len(missing) == 1:
+        save_timestamps[missing[0]] = read_save_timestamp(file_paths[missing[0]])
+    elif missing:
+        with futures.ProcessPoolExecutor(len(missing)) as executor:
+            for i, save_timestamp in zip(missing, executor.map(read_save_timestamp, [file_paths[i] for i in missing])):
+                save_timestamps[i] = save_timestamp
+
+    return save_timestamps
 
 def get_latest_save_file(config: dict):
     save_latest_at = 0
     save_latest_file = ""
     save_time_ats = {}
 
-    for save_file in ('save.json', 'save-int.json', 'save-prev.json'):
-        file_path = os.path.join(config['save_path'], save_file)
-
-        file_handler = open(file_path, 'r')
-        save_object = json.loads(file_handler.read())
-        file_handler.close()
-
-        save_timestamp = save_object['Timestamp']
+    file_paths = [os.path.join(config['save_path'], save_file) for save_file in SAVE_FILES]
+    save_timestamps = read_save_timestamps(file_paths)
 
+    for save_file, save_timestamp in zip(SAVE_FILES, save_timestamps):
         if save_latest_at == 0 and save_latest_file == "":
             save_latest_at = save_timestamp
             save_latest_file = save_file
@@ -39,47 +72,74 @@ def get_latest_save_file(config: dict):
     return save_latest_file
 
 class Entities:
+    # entities are indexed by Type and by ID in one pass on the first query, later queries are
+    # dict lookups. Call build_index again after entities were added or removed
     def __init__(self, save_object: dict):
         self.save_object = save_object
         self.entities = self.save_object['Entities']
+        self.entities_by_type = None
+        self.entities_by_id = None
+
+    def build_index(self):
+        self.entities_by_type = {}
+        self.entities_by_id = {}
 
-    def get_inventory_id(self) -> str:
         for entity in self.entities:
-            if entity['Type'] == Entity.Player.value:
-                return entity['InventoryId']
+            self.entities_by_type.setdefault(entity['Type'], []).append(entity)
+            if 'ID' in entity:
+                self.entities_by_id.setdefault((entity['Type'], entity['ID']), entity)
+                self.entities_by_id.setdefault((None, entity['ID']), entity)
+
+    def get_entities(self, kind: Entity) -> list:
+        if self.entities_by_type is None:
+            self.build_index()
+
+        return self.entities_by_type.get(kind.value, [])
 
-        raise RuntimeError('Cannot find inventory id')
+    def get_entity(self, kind: Entity) -> dict:
+        # the single entity of a kind like Player, Weather or Calendar
+        entities = self.get_entities(kind)
+        if not entities:
+            raise RuntimeError('Cannot find {} entity'.format(kind.name))
+
+        return entities[0]
+
+    def get_entity_by_id(self, id: str, kind: Optional[Entity] = None) -> Optional[dict]:
+        if self.entities_by_id is None:
+            self.build_index()
+
+        return self.entities_by_id.get((None if kind is None else kind.value, id))
+
+    def get_inventory_id(self) -> str:
+        players = self.get_entities(Entity.Player)
+        if not players:
+            raise RuntimeError('Cannot find inventory id')
+
+        return players[0]['InventoryId']
 
     def get_inventory(self, id: str) -> dict:
-        for entity in self.entities:
-            if entity['Type'] == Entity.Inventory.value and entity['ID'] == id:
-                return entity
+        inventory = self.get_entity_by_id(id, Entity.Inventory)
+        if inventory is None:
+            raise RuntimeError('Cannot find inventory data')
 
-        raise RuntimeError('Cannot find inventory data')
+        return inventory
 
     def get_inventory_regular_slots(self, inventory_object: dict) -> list:
         return inventory_object['RegularSlots']
 
     def get_storage_boxes(self) -> list:
-        # storage_boxes = []
-        # for entity in self.entities:
-        #     if entity['Type'] == Entity.StorageBox.value:
-        #         storage_boxes.append(entity)
-        # return storage_boxes
-        return list(filter(lambda entity: entity['Type'] == Entity.StorageBox.value, self.entities))
+        return self.get_entities(Entity.StorageBox)
 
     def get_storage_box_slots(self, storage_box: dict) -> list:
         return storage_box['Slots']
 
-def run(config: dict):
-    config['save_full_path'] = os.path.join(
-        config['save_path'],
-        get_latest_save_file(config) if config['auto_find'] else config['save_file']
-    )
-
-    if os.path.exists(config['save_full_path']) is False:
-        raise RuntimeError('Cannot find save file: {}'.format(config['save_full_path']))
+def patch_slots(slots: list, config: dict):
+    for slot in slots:
+        if 'ItemWithProperties' in slot:
+            slot['ItemWithProperties']['Quality'] = config['inventory']['quality']
+            slot['SyncedQ'] = config['inventory']['synced_q']
 
+def patch_in_memory(config: dict):
     save_content = open(config['save_full_path']).read()
     save_object = json.loads(save_content)
 
@@ -87,23 +147,353 @@ def run(config: dict):
 
     inventory_id = entities.get_inventory_id()
     inventory = entities.get_inventory(inventory_id)
-    inventory_regular_slots = entities.get_inventory_regular_slots(inventory)
-    for slot in inventory_regular_slots:
-        if 'ItemWithProperties' in slot:
-            slot['ItemWithProperties']['Quality'] = config['inventory']['quality']
-            slot['SyncedQ'] = config['inventory']['synced_q']
+    patch_slots(entities.get_inventory_regular_slots(inventory), config)
 
     storage_boxes = entities.get_storage_boxes()
     for storage_box in storage_boxes:
-        storage_box_slots = entities.get_storage_box_slots(storage_box)
-        for slot in storage_box_slots:
-            if 'ItemWithProperties' in slot:
-                slot['ItemWithProperties']['Quality'] = config['inventory']['quality']
-                slot['SyncedQ'] = config['inventory']['synced_q']
+        patch_slots(entities.get_storage_box_slots(storage_box), config)
 
     with open(config['save_full_path'], 'w+') as f:
         f.write(json.dumps(save_object))
 
+def read_entities(stream: JsonStream) -> Iterator[tuple[dict, str]]:
+    # the elements of a JSON array as (entity, raw text) pairs
+    stream.expect('[')
+    if stream.peek() == ']':
+        stream.expect(']')
+        return
+
+    while True:
+        yield stream.read_value()
+        if stream.peek() == ']':
+            stream.expect(']')
+            return
+        stream.expect(',')
+
+def encode_like(entity: dict, raw: str) -> str:
+    # encodes a patched entity in the layout of its source text: indented with the same indent,
+    # depth and line ending, or on one line with or without spaces after ':' and ','. Text
+    # without any non-ASCII character keeps \uXXXX escapes like the default of json.dumps
+    ensure_ascii = raw.isascii()
+    if '\n' in raw:
+        newline = '\r\n' if '\r\n' in raw else '\n'
+        base = raw[raw.rfind('\n') + 1:-1]
+        inner = raw[raw.find('\n') + 1:]
+        indent = inner[:len(inner) - len(inner.lstrip(' \t'))]
+        if indent.startswith(base) and len(indent) > len(base):
+            return json.dumps(entity, ensure_ascii=ensure_ascii, indent=indent[len(base):]).replace('\n', newline + base)
+
+    colon = raw.find(':')
+    comma = raw.find(',', colon)
+    key_separator = ': ' if raw.startswith(' ', colon + 1) else ':'
+    item_separator = ', ' if comma != -1 and raw.startswith(' ', comma + 1) else ','
+    return json.dumps(entity, ensure_ascii=ensure_ascii, separators=(item_separator, key_separator))
+
+def write_entities(stream: JsonStream, target: TextIO, patcher: RulePatcher) -> int:
+    # entities are decoded one at a time, the ones no rule changed are copied as they are and the
+    # text between them is copied from the echo of the stream. A rule like the player inventory
+    # one can only match once the Player entity was seen, so when an entity waits for it, it and
+    # everything after it are spooled to a temporary file until then
+    deferred = None
+    deferred_separator = ''
+    patched = 0
+
+    def write(entity: dict, raw: str, separator: str):
+        nonlocal patched
+
+        if patcher.patch(entity):
+            raw = encode_like(entity, raw)
+            patched += 1
+
+        target.write(separator + raw)
+
+    def write_deferred():
+        # the spooled entities keep their separators, only the first one was replaced by '['
+        deferred.write(']')
+        deferred.seek(0)
+        deferred_stream = JsonStream(deferred, echo=True)
+        first = True
+        for deferred_entity, deferred_raw in read_entities(deferred_stream):
+            separator = deferred_stream.take()
+            write(deferred_entity, deferred_raw, deferred_separator if first else separator)
+            first = False
+        deferred.close()
+
+    for entity, raw in read_entities(stream):
+        separator = stream.take()
+        patcher.observe(entity)
+
+        if deferred is not None and patcher.resolved():
+            write_deferred()
+            deferred = None
+
+        if deferred is not None or patcher.wait_for_reference(entity):
+            if deferred is None:
+                deferred = tempfile.TemporaryFile('w+', encoding='utf-8', errors='surrogateescape', newline='')
+                deferred_separator = separator
+                deferred.write('[' + raw)
+            else:
+                deferred.write(separator + raw)
+            continue
+
+        write(entity, raw, separator)
+
+    target.write(stream.take())
+
+    if not patcher.resolved():
+        raise RuntimeError('Cannot find {}'.format(', '.join(patcher.unresolved())))
+
+    return patched
+
+def patch_streaming(save_full_path: str, rules: list[Rule]) -> int:
+    # the patched save is written next to the original and renamed over it once complete,
+    # only the top level keys and a single entity are in memory at any time. Returns how
+    # many entities were changed
+    temporary_path = save_full_path + '.tmp'
+    patcher = RulePatcher(rules)
+    patched = 0
+
+    try:
+        # newline='' keeps \r\n line endings as they are on every platform, surrogateescape copies
+        # bytes that are not valid UTF-8 through unchanged, like the --in-place scan reads them
+        with open(save_full_path, encoding='utf-8', errors='surrogateescape', newline='') as source, \
+             open(temporary_path, 'w', encoding='utf-8', errors='surrogateescape', newline='') as target:
+            # everything read is either a value or echoed text, written out in the same order
+            stream = JsonStream(source, echo=True)
+            stream.expect('{')
+
+            first = True
+            while stream.peek() != '}':
+                if not first:
+                    stream.expect(',')
+                first = False
+
+                key, raw_key = stream.read_value()
+                target.write(stream.take() + raw_key)
+                stream.expect(':')
+
+                if key == 'Entities':
+                    patched = write_entities(stream, target, patcher)
+                else:
+                    raw_value = stream.read_value()[1]
+                    target.write(stream.take() + raw_value)
+
+            stream.expect('}')
+            stream.skip_whitespace()
+            target.write(stream.take())
+
+            # the rename should never expose a save whose content is not on the disk yet
+            target.flush()
+            os.fsync(target.fileno())
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+    os.replace(temporary_path, save_full_path)
+    return patched
+
+def value_at(node, path: tuple):
+    for key in path:
+        node = node[key]
+    return node
+
+def encode_text(text: str) -> bytes:
+    # surrogateescape gives back the exact bytes of a save that is not valid UTF-8
+    return text.encode('utf-8', 'surrogateescape')
+
+def byte_length(text: str) -> int:
+    return len(text) if text.isascii() else len(encode_text(text))
+
+def entity_edits(entity: dict, raw: str, start: int, patcher: RulePatcher) -> Optional[list]:
+    # (byte offset, bytes) edits that turn raw into the patched entity, None when a new value
+    # does not fit in place of the old one or a rule created a field, shorter values are padded
+    # with spaces which JSON ignores
+    changed = patcher.patch(entity)
+    if not changed:
+        return []
+
+    edits = []
+    offset, position = start, 0 # raw[:position] is offset - start bytes long
+    for path, (value_start, value_end) in sorted(value_spans(raw).items(), key=lambda item: item[1]):
+        old_raw = raw[value_start:value_end]
+        old_value = json.loads(old_raw)
+        try:
+            value = value_at(entity, path)
+        except (KeyError, IndexError, TypeError):
+            return None # a rule replaced a list or object
+        if value == old_value and type(value) is type(old_value):
+            continue
+
+        new_data = encode_text(json.dumps(value, ensure_ascii=raw.isascii())) # escaped like encode_like
+        old_length = byte_length(old_raw)
+        if len(new_data) > old_length:
+            return None
+
+        offset += byte_length(raw[position:value_start])
+        position = value_start
+        edits.append((offset, new_data.ljust(old_length)))
+
+    return edits if len(edits) == changed else None
+
+def collect_edits(save_full_path: str, rules: list[Rule]) -> tuple[Optional[list], int]:
+    # stream offsets count characters, the JSON structure and whitespace are ASCII so only the
+    # values read so far can make the byte offset larger, extra sums that difference. Entities
+    # that wait for a reference are only remembered by byte offset and read again later
+    patcher = RulePatcher(rules)
+    edits = []
+    patched = 0
+    waiting = []
+    extra = 0
+
+    def add(entity: dict, raw: str, start: int) -> bool:
+        nonlocal patched
+
+        entity_edit = entity_edits(entity, raw, start, patcher)
+        if entity_edit is None:
+            return False
+        if entity_edit:
+            edits.extend(entity_edit)
+            patched += 1
+        return True
+
+    def read_value(stream: JsonStream):
+        nonlocal extra
+
+        value, raw = stream.read_value()
+        extra += byte_length(raw) - len(raw)
+        return value
+
+    with open(save_full_path, encoding='utf-8', errors='surrogateescape', newline='') as source:
+        stream = JsonStream(source)
+        stream.expect('{')
+        first = True
+        while stream.peek() != '}':
+            if not first:
+                stream.expect(',')
+            first = False
+
+            key = read_value(stream)
+            stream.expect(':')
+            if key != 'Entities':
+                read_value(stream)
+                continue
+
+            for entity, raw in read_entities(stream):
+                start = stream.tell() - len(raw) + extra
+                length = byte_length(raw)
+                extra += length - len(raw)
+
+                patcher.observe(entity)
+                if patcher.wait_for_reference(entity):
+                    waiting.append((start, length))
+                elif not add(entity, raw, start):
+                    return None, 0
+
+    if not patcher.resolved():
+        raise RuntimeError('Cannot find {}'.format(', '.join(patcher.unresolved())))
+
+    with open(save_full_path, 'rb') as source:
+        for start, length in waiting:
+            source.seek(start)
+            raw = source.read(length).decode('utf-8', 'surrogateescape')
+            if not add(json.loads(raw), raw, start):
+                return None, 0
+
+    return edits, patched
+
+def patch_in_place(save_full_path: str, rules: list[Rule]) -> tuple[int, int]:
+    # only the bytes of the changed values are written, the rest of the save stays byte
+    # identical. Falls back to patch_streaming when a value does not fit. Returns the changed
+    # entities and the bytes written
+    edits, patched = collect_edits(save_full_path, rules)
+    if edits is None:
+        patched = patch_streaming(save_full_path, rules)
+        return patched, os.path.getsize(save_full_path)
+
+    if edits:
+        with open(save_full_path, 'r+b') as target:
+            for offset, data in edits:
+                target.seek(offset)
+                target.write(data)
+            target.flush()
+            os.fsync(target.fileno())
+
+    return patched, sum(len(data) for _, data in edits)
+
+def inventory_rules(config: dict) -> list[Rule]:
+    # the default patch: every item in the player inventory and the storage boxes
+    quality, synced_q = config['inventory']['quality'], config['inventory']['synced_q']
+
+    return [parse_rule(rule) for rule in [
+        {'entity': 'Inventory', 'id': '@Player.InventoryId', 'path': 'RegularSlots[].ItemWithProperties.Quality', 'value': quality, 'create': True},
+        {'entity': 'Inventory', 'id': '@Player.InventoryId', 'path': 'RegularSlots[].SyncedQ', 'value': synced_q, 'create': True, 'require': ['ItemWithProperties']},
+        {'entity': 'StorageBox', 'path': 'Slots[].ItemWithProperties.Quality', 'value': quality, 'create': True},
+        {'entity': 'StorageBox', 'path': 'Slots[].SyncedQ', 'value': synced_q, 'create': True, 'require': ['ItemWithProperties']},
+    ]]
+
+def find_save_files(root: str) -> list:
+    save_files = []
+    for directory, _, file_names in os.walk(root):
+        save_files.extend(os.path.join(directory, file_name) for file_name in sorted(file_names) if file_name in SAVE_FILES)
+
+    return sorted(save_files)
+
+def patch_save_file(save_full_path: str, rules: list[Rule], in_place: bool = False) -> tuple:
+    # runs in a worker process, errors are returned so one broken save does not stop the batch
+    started_at = time.perf_counter()
+    try:
+        patched = patch_in_place(save_full_path, rules)[0] if in_place else patch_streaming(save_full_path, rules)
+        error = None
+    except Exception as e:
+        patched, error = 0, '{}: {}'.format(type(e).__name__, e)
+
+    return save_full_path, time.perf_counter() - started_at, patched, error
+
+def patch_batch(config: dict, rules: list[Rule]) -> int:
+    # returns how many saves failed
+    save_files = find_save_files(config['save_path'])
+    if not save_files:
+        raise RuntimeError('Cannot find any save file in: {}'.format(config['save_path']))
+
+    started_at = time.perf_counter()
+    failed = 0
+
+    with futures.ProcessPoolExecutor(config['workers']) as executor:
+        tasks = [executor.submit(patch_save_file, save_file, rules, config['in_place']) for save_file in save_files]
+        for task in futures.as_completed(tasks):
+            save_full_path, seconds, patched, error = task.result()
+            if error is None:
+                print('[OK] {:8.3f}s {:>7,} entities  {}'.format(seconds, patched, save_full_path))
+            else:
+                print('[Error] {:5.3f}s {}  {}'.format(seconds, error, save_full_path))
+                failed += 1
+
+    print('[Done] {:,} saves, {:,} failed, {:.2f}s'.format(len(save_files), failed, time.perf_counter() - started_at))
+    return failed
+
+def run(config: dict):
+    rules = load_rules(config['rules']) if config['rules'] else inventory_rules(config)
+
+    if config['batch']:
+        return patch_batch(config, rules)
+
+    config['save_full_path'] = os.path.join(
+        config['save_path'],
+        get_latest_save_file(config) if config['auto_find'] else config['save_file']
+    )
+
+    if os.path.exists(config['save_full_path']) is False:
+        raise RuntimeError('Cannot find save file: {}'.format(config['save_full_path']))
+
+    if config['in_memory']:
+        if config['rules']:
+            raise RuntimeError('Rule files are only applied to streamed saves')
+        patch_in_memory(config)
+    elif config['in_place']:
+        patch_in_place(config['save_full_path'], rules)
+    else:
+        patch_streaming(config['save_full_path'], rules)
+
 def main():
     parser = argparse.ArgumentParser(
         prog='max inventory',
@@ -111,12 +501,20 @@ def main():
     )
     parser.add_argument('--auto', action='store_true', default=False, help='enable auto find save mode')
     parser.add_argument('-p', '--path', required=True, help='which save path should be searched')
-    parser.add_argument('-f', '--file', required=True, help='which save file should be used')
+    parser.add_argument('-f', '--file', help='which save file should be used')
     parser.add_argument('--quality', type=int, default=Quality.Best.value, help='which item quality should be set [0-3, default: 3]')
     parser.add_argument('--amount', type=int, default=255, help='how many item amount should be set [1-255, default: 255]')
+    parser.add_argument('--in-memory', action='store_true', default=False, help='load the whole save instead of streaming it')
+    parser.add_argument('--in-place', action='store_true', default=False, help='only rewrite the changed values when they fit, keep the rest of the save as it is')
+    parser.add_argument('--rules', help='apply the rules in this JSON file instead of the quality and amount patch')
+    parser.add_argument('--batch', action='store_true', default=False, help='patch every save file below the save path')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='how many saves are patched at once in batch mode')
 
     args = parser.parse_args()
 
+    if not args.batch and not args.auto and not args.file:
+        parser.error('the following arguments are required: -f/--file')
+
     # save path should be like
     # mac: $HOME/Library/Application Support/Soda Den/Roots of Pacha/saves/[USER_ID]
     # win: %USERPROFILE%\AppData\LocalLow\Soda Den\Roots of Pacha\saves\[USER_ID]
@@ -133,12 +531,18 @@ def main():
         'auto_find': args.auto,
         'save_path': args.path,
         'save_file': args.file,
+        'in_memory': args.in_memory,
+        'in_place': args.in_place,
+        'rules': args.rules,
+        'batch': args.batch,
+        'workers': args.workers,
         'inventory': {
             'quality' : args.quality,
             'synced_q': args.amount,
         }
     }
-    run(config)
+    if run(config):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+import json
+import re
+from typing import Any, NamedTuple, Optional
+from kind import Entity
+
+# a rule file is a JSON list of rules like
+#
+#   {
+#       "entity" : "StorageBox",                       # name in the Entity enum
+#       "path"   : "Slots[].ItemWithProperties.Quality", # [] is every element, [2] only one
+#       "value"  : 3,
+#       "id"     : "@Player.InventoryId",              # optional, an ID or a field of another entity
+#       "require": ["ItemWithProperties"],             # optional, keys next to the field
+#       "create" : false                               # optional, set the field when it is missing
+#   }
+PATH_TOKEN = re.compile(r'([^.\[\]]+)|\[(\d*)\]')
+
+EVERY = '[]'
+
+class Rule(NamedTuple):
+    kind: int
+    path: tuple
+    value: Any
+    id: Optional[str] = None
+    reference: Optional[tuple[int, str]] = None # (entity type, field) that holds the id
+    require: tuple = ()
+    create: bool = False
+
+def parse_path(text: str) -> tuple:
+    tokens = []
+    position = 0
+    while position < len(text):
+        if text[position] == '.' and tokens:
+            position += 1
+
+        match = PATH_TOKEN.match(text, position)
+        if match is None:
+            raise ValueError('Invalid path: {}'.format(text))
+
+        if match.group(1) is not None:
+            tokens.append(match.group(1))
+        else:
+            tokens.append(EVERY if match.group(2) == '' else int(match.group(2)))
+        position = match.end()
+
+    if not tokens or not isinstance(tokens[-1], str):
+        raise ValueError('Path should end with a field name: {}'.format(text))
+
+    return tuple(tokens)
+
+def parse_kind(name: str) -> int:
+    if name not in Entity.__members__:
+        raise ValueError('Unknown entity type: {}'.format(name))
+
+    return Entity[name].value
+
+def parse_rule(data: dict) -> Rule:
+    id = data.get('id')
+    reference = None
+    if isinstance(id, str) and id.startswith('@'):
+        kind_name, _, field = id[1:].partition('.')
+        if not field:
+            raise ValueError('Reference should be like @Player.InventoryId: {}'.format(id))
+        id, reference = None, (parse_kind(kind_name), field)
+
+    return Rule(
+        parse_kind(data['entity']),
+        parse_path(data['path']),
+        data['value'],
+        id,
+        reference,
+        tuple(data.get('require', ())),
+        bool(data.get('create', False)),
+    )
+
+def load_rules(file_path: str) -> list[Rule]:
+    with open(file_path, encoding='utf-8') as f:
+        data = json.load(f)
+
+    if not isinstance(data, list):
+        raise ValueError('Rule file should contain a list of rules: {}'.format(file_path))
+
+    return [parse_rule(rule) for rule in data]
+
+def reference_name(reference: tuple[int, str]) -> str:
+    return '@{}.{}'.format(Entity(reference[0]).name, reference[1])
+
+def apply_path(node: Any, path: tuple, rule: Rule) -> int:
+    # returns how many values were changed
+    token = path[0]
+
+    if len(path) == 1:
+        if not isinstance(node, dict) or any(key not in node for key in rule.require):
+            return 0
+        if token not in node and not rule.create:
+            return 0
+        if token in node and node[token] == rule.value:
+            return 0
+        node[token] = rule.value
+        return 1
+
+    if token == EVERY:
+        return sum(apply_path(item, path[1:], rule) for item in node) if isinstance(node, list) else 0
+    if isinstance(token, int):
+        return apply_path(node[token], path[1:], rule) if isinstance(node, list) and token < len(node) else 0
+    if isinstance(node, dict) and token in node:
+        return apply_path(node[token], path[1:], rule)
+
+    return 0
+
+class RulePatcher:
+    # applies every rule to the entities of one save in a single pass. Rules with an id reference
+    # can only match once the referenced entity was seen, observe() is called for every entity so
+    # the caller can hold back the ones that wait_for_reference() until resolved()
+    def __init__(self, rules: list[Rule]):
+        self.rules_by_kind: dict[int, list[Rule]] = {}
+        for rule in rules:
+            self.rules_by_kind.setdefault(rule.kind, []).append(rule)
+
+        self.references = {rule.reference for rule in rules if rule.reference is not None}
+        self.references_by_kind: dict[int, list[tuple[int, str]]] = {}
+        for reference in self.references:
+            self.references_by_kind.setdefault(reference[0], []).append(reference)
+        self.values: dict[tuple[int, str], Any] = {}
+
+    def observe(self, entity: dict):
+        for reference in self.references_by_kind.get(entity['Type'], ()):
+            if reference not in self.values and reference[1] in entity:
+                self.values[reference] = entity[reference[1]]
+
+    def resolved(self) -> bool:
+        return len(self.values) == len(self.references)
+
+    def unresolved(self) -> list[str]:
+        return sorted(reference_name(reference) for reference in self.references - self.values.keys())
+
+    def wait_for_reference(self, entity: dict) -> bool:
+        return any(
+            rule.reference is not None and rule.reference not in self.values
+            for rule in self.rules_by_kind.get(entity['Type'], ())
+        )
+
+    def patch(self, entity: dict) -> int:
+        changed = 0
+        for rule in self.rules_by_kind.get(entity['Type'], ()):
+            if rule.reference is not None:
+                if entity.get('ID') != self.values.get(rule.reference):
+                    continue
+            elif rule.id is not None and entity.get('ID') != rule.id:
+                continue
+
+            changed += apply_path(entity, rule.path, rule)
+
+        return changed
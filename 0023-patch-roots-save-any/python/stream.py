@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import json
+import re
+from typing import Any, Optional, TextIO
+
+READ_CHARS = 1 << 20
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class JsonStream:
+    # a window over a large JSON text, values are decoded one by one with raw_decode and the text
+    # before them is dropped, so memory follows the largest single value instead of the file.
+    # With echo the whitespace and punctuation that were skipped are kept until take(), so the
+    # text between two values can be copied through as it was
+    def __init__(self, file: TextIO, echo: bool = False):
+        self.file = file
+        self.echo = echo
+        self.echoed: list[str] = []
+        self.buffer = ""
+        self.position = 0
+        self.offset = 0 # characters dropped in front of the buffer
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self, size: int = READ_CHARS) -> bool:
+        if self.eof:
+            return False
+
+        chunk = self.file.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.offset += self.position
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def tell(self) -> int:
+        # offset of the next character from the start of the file
+        return self.offset + self.position
+
+    def skip_whitespace(self) -> None:
+        # compact saves have no whitespace between tokens, check that case before the regex
+        if self.position < len(self.buffer) and self.buffer[self.position] not in ' \t\n\r':
+            return
+
+        while True:
+            start = self.position
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+            if self.echo and self.position > start:
+                self.echoed.append(self.buffer[start:self.position])
+            if self.position < len(self.buffer) or not self.fill():
+                return
+
+    def peek(self) -> str:
+        self.skip_whitespace()
+        return self.buffer[self.position:self.position + 1]
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError('Expected {} but found {}'.format(repr(char), repr(self.buffer[self.position:self.position + 20])))
+        self.position += 1
+        if self.echo:
+            self.echoed.append(char)
+
+    def take(self) -> str:
+        # the text skipped since the last take, only kept with echo
+        text = ''.join(self.echoed)
+        self.echoed.clear()
+        return text
+
+    def read_value(self) -> tuple[Any, str]:
+        # returns the decoded value and its raw text, a value that ends with the buffer (like a
+        # number cut in half) is only accepted at the end of the file
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                if end < len(self.buffer) or self.eof:
+                    raw = self.buffer[self.position:end]
+                    self.position = end
+                    return value, raw
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            # values larger than the window double it, so each one is decoded a few times at most
+            self.fill(max(READ_CHARS, len(self.buffer) - self.position))
+
+def probe_key(text: str, key: str) -> Optional[Any]:
+    # looks for a top level key in the start of a JSON object, returns None when the key is not
+    # there or a value in front of it does not end inside the text, so the caller can fall back
+    decoder = json.JSONDecoder()
+    position = WHITESPACE.match(text).end()
+    if text[position:position + 1] != '{':
+        return None
+
+    position += 1
+    while True:
+        try:
+            position = WHITESPACE.match(text, position).end()
+            name, position = decoder.raw_decode(text, position)
+            position = WHITESPACE.match(text, position).end()
+            if text[position:position + 1] != ':':
+                return None
+
+            position = WHITESPACE.match(text, position + 1).end()
+            value, position = decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            return None
+
+        # a number that ends with the text may have been cut in half
+        if position >= len(text):
+            return None
+        if name == key:
+            return value
+
+        position = WHITESPACE.match(text, position).end()
+        if text[position:position + 1] != ',':
+            return None
+        position += 1
+
+def value_spans(text: str, position: int = 0, path: tuple = (), spans: Optional[dict] = None) -> dict:
+    # {path: (start, end)} of every number, string, bool and null in the JSON value at position,
+    # paths are keys and list indexes like ('Slots', 3, 'SyncedQ')
+    spans = {} if spans is None else spans
+    value_end(text, WHITESPACE.match(text, position).end(), path, spans, json.JSONDecoder())
+    return spans
+
+def value_end(text: str, position: int, path: tuple, spans: dict, decoder: json.JSONDecoder) -> int:
+    char = text[position:position + 1]
+    if char not in ('{', '['):
+        _, end = decoder.raw_decode(text, position)
+        spans[path] = (position, end)
+        return end
+
+    closing = '}' if char == '{' else ']'
+    position = WHITESPACE.match(text, position + 1).end()
+    if text[position:position + 1] == closing:
+        return position + 1
+
+    index = 0
+    while True:
+        if char == '{':
+            key, position = decoder.raw_decode(text, position)
+            position = WHITESPACE.match(text, position).end()
+            if text[position:position + 1] != ':':
+                raise ValueError('Expected \':\' at {}'.format(position))
+            position = WHITESPACE.match(text, position + 1).end()
+        else:
+            key = index
+            index += 1
+
+        position = value_end(text, position, path + (key,), spans, decoder)
+        position = WHITESPACE.match(text, position).end()
+        if text[position:position + 1] == closing:
+            return position + 1
+        if text[position:position + 1] != ',':
+            raise ValueError('Expected \',\' or {} at {}'.format(repr(closing), position))
+        position = WHITESPACE.match(text, position + 1).end()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import time
+from hashlib import sha256
+from typing import Optional, Self
+from hashers import FileTimings, Hasher, finish, read_buffer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# content defined chunking with a gear hash: h = (h << 1) + GEAR[byte], a chunk ends after a byte
+# whose hash has the low CHUNK_MASK bits clear. Only the low 32 bits are used, they depend on the
+# last 32 bytes alone, so an insert or delete only moves the boundaries next to it
+CHUNK_MIN_BYTES = 256 << 10
+CHUNK_MAX_BYTES = 4 << 20
+CHUNK_MASK = (1 << 20) - 1 # about 1 MiB on top of CHUNK_MIN_BYTES on average
+CHUNK_WINDOW_BYTES = 32
+CHUNK_READ_BYTES = 8 << 20
+
+CHUNK_FILE_BYTES = 16 << 20 # files below this size are only hashed as a whole
+
+GEAR = [int.from_bytes(sha256(bytes([i])).digest()[:4], 'little') for i in range(256)]
+GEAR_ARRAY = None if np is None else np.array(GEAR, dtype=np.uint32)
+
+Chunk = tuple[int, int] # (length, checksum)
+
+def available() -> bool:
+    return np is not None
+
+def gear_hashes(window: 'np.ndarray') -> 'np.ndarray':
+    # h[i] = sum(GEAR[window[i - j]] << j for j < 32), built in five doubling steps instead of
+    # 32 passes, the first CHUNK_WINDOW_BYTES - 1 values only see the bytes inside the window
+    hashes = GEAR_ARRAY[window]
+    shifted = np.empty_like(hashes)
+    shift = 1
+    while shift < CHUNK_WINDOW_BYTES:
+        np.left_shift(hashes[:-shift], np.uint32(shift), out=shifted[shift:])
+        hashes[shift:] += shifted[shift:]
+        shift *= 2
+
+    return hashes
+
+class Chunker:
+    # feeds the file block by block and returns the absolute end offset of every finished chunk
+    def __init__(self: Self) -> None:
+        self.tail = np.zeros(0, dtype=np.uint8)
+        self.offset = 0
+        self.chunk_start = 0
+
+    def feed(self: Self, data: memoryview) -> list[int]:
+        window = np.concatenate((self.tail, np.frombuffer(data, dtype=np.uint8)))
+        hashes = gear_hashes(window)[len(self.tail):]
+        candidates = np.flatnonzero((hashes & np.uint32(CHUNK_MASK)) == 0) + (self.offset + 1)
+
+        boundaries = []
+        for end in candidates.tolist():
+            while end - self.chunk_start > CHUNK_MAX_BYTES:
+                self.chunk_start += CHUNK_MAX_BYTES
+                boundaries.append(self.chunk_start)
+            if end - self.chunk_start >= CHUNK_MIN_BYTES:
+                self.chunk_start = end
+                boundaries.append(end)
+
+        self.offset += len(data)
+        while self.offset - self.chunk_start >= CHUNK_MAX_BYTES:
+            self.chunk_start += CHUNK_MAX_BYTES
+            boundaries.append(self.chunk_start)
+
+        self.tail = window[-(CHUNK_WINDOW_BYTES - 1):]
+        return boundaries
+
+def hash_file_chunks(path: str, hasher: Hasher, timings: Optional[FileTimings] = None) -> tuple[int, tuple[Chunk, ...]]:
+    # one read of the file gives the whole file checksum (same as hash_file) and the chunks
+    timings = timings if timings is not None else FileTimings()
+    timings.hashed_files += 1
+    file_state = hasher.new()
+    chunk_state = hasher.new()
+    chunker = Chunker()
+    chunks = []
+    chunk_start = 0
+    buffer = read_buffer(CHUNK_READ_BYTES)
+    started_at = time.perf_counter()
+
+    with open(path, 'rb', buffering=0) as f:
+        offset = 0
+        while True:
+            length = f.readinto(buffer)
+            read_at = time.perf_counter()
+            timings.read_seconds += read_at - started_at
+            if not length:
+                break
+
+            block = buffer[:length]
+            file_state.update(block)
+
+            position = 0
+            for end in chunker.feed(block):
+                chunk_state.update(block[position:end - offset])
+                chunks.append((end - chunk_start, finish(chunk_state)))
+                chunk_state = hasher.new()
+                chunk_start = end
+                position = end - offset
+            chunk_state.update(block[position:])
+
+            offset += length
+            timings.bytes_read += length
+            started_at = time.perf_counter()
+            timings.hash_seconds += started_at - read_at
+
+    if offset > chunk_start:
+        chunks.append((offset - chunk_start, finish(chunk_state)))
+
+    return finish(file_state), tuple(chunks)
+
+def changed_ranges(first: tuple[Chunk, ...], second: tuple[Chunk, ...]) -> list[tuple[int, int]]:
+    # (offset, length) ranges of the second file whose chunks do not appear in the first one,
+    # neighbouring ranges are merged
+    known = set(first)
+    ranges: list[tuple[int, int]] = []
+    offset = 0
+    for chunk in second:
+        length = chunk[0]
+        if chunk not in known:
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((offset, length))
+        offset += length
+
+    return ranges
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import hashlib
+import mmap
+import threading
+import time
+from typing import Callable, NamedTuple, Optional, Protocol
+from zlib import crc32 # same values as binascii.crc32, releases the GIL on large buffers
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+MMAP_THRESHOLD_BYTES = 64 << 20 # larger files are hashed straight from a memory map
+MMAP_SLICE_BYTES = 16 << 20
+
+class HashState(Protocol):
+    def update(self, data: bytes) -> None: ...
+    def digest(self) -> bytes: ...
+
+class Crc32State:
+    def __init__(self) -> None:
+        self.value = 0
+
+    def update(self, data: bytes) -> None:
+        self.value = crc32(data, self.value)
+
+    def digest(self) -> bytes:
+        return self.value.to_bytes(4, 'big')
+
+class Hasher(NamedTuple):
+    id: int          # stored in the snapshot header, never reuse a number
+    name: str
+    width: int       # checksum size in bytes
+    read_size: int   # bytes per read for files below MMAP_THRESHOLD_BYTES
+    cpu_heavy: bool  # hashed in worker processes unless threads are asked for
+    new: Callable[[], HashState]
+
+def new_xxhash(name: str) -> Callable[[], HashState]:
+    def new() -> HashState:
+        if xxhash is None:
+            raise RuntimeError(f"Hash algorithm {name} needs the xxhash package, run `make vendor` first")
+        return getattr(xxhash, name)()
+    return new
+
+HASHERS = {hasher.name: hasher for hasher in (
+    Hasher(0, 'crc32'  , 4 , 256 << 10, False, Crc32State),
+    Hasher(1, 'xxh64'  , 8 , 1 << 20  , False, new_xxhash('xxh64')),
+    Hasher(2, 'xxh128' , 16, 1 << 20  , False, new_xxhash('xxh3_128')),
+    Hasher(3, 'blake2b', 32, 1 << 20  , True , lambda: hashlib.blake2b(digest_size=32)),
+    Hasher(4, 'sha256' , 32, 1 << 20  , True , hashlib.sha256),
+)}
+HASHERS_BY_ID = {hasher.id: hasher for hasher in HASHERS.values()}
+
+DEFAULT_HASHER = HASHERS['crc32']
+
+class FileTimings:
+    # seconds and bytes spent on a batch of files, sent back from the workers with the checksums
+    def __init__(self) -> None:
+        self.stat_seconds = 0.0
+        self.read_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.bytes_read = 0
+        self.hashed_files = 0
+
+    def merge(self, other: 'FileTimings') -> None:
+        self.stat_seconds += other.stat_seconds
+        self.read_seconds += other.read_seconds
+        self.hash_seconds += other.hash_seconds
+        self.bytes_read += other.bytes_read
+        self.hashed_files += other.hashed_files
+
+    def seconds(self) -> float:
+        return self.stat_seconds + self.read_seconds + self.hash_seconds
+
+# one read buffer per worker thread, reused for every file the thread hashes
+buffers = threading.local()
+
+def read_buffer(size: int) -> memoryview:
+    buffer = getattr(buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = buffers.buffer = memoryview(bytearray(size))
+    return buffer[:size]
+
+def finish(state: HashState) -> int:
+    return int.from_bytes(state.digest(), 'big')
+
+def hash_file(path: str, hasher: Hasher, timings: Optional[FileTimings] = None) -> int:
+    timings = timings if timings is not None else FileTimings()
+    timings.hashed_files += 1
+    state = hasher.new()
+    started_at = time.perf_counter()
+
+    with open(path, 'rb', buffering=0) as f:
+        size = f.seek(0, 2)
+        f.seek(0)
+
+        if size >= MMAP_THRESHOLD_BYTES:
+            # pages are read while they are hashed, the whole time counts as hashing
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for offset in range(0, len(view), MMAP_SLICE_BYTES):
+                    state.update(view[offset:offset + MMAP_SLICE_BYTES])
+            timings.hash_seconds += time.perf_counter() - started_at
+            timings.bytes_read += size
+            return finish(state)
+
+        buffer = read_buffer(hasher.read_size)
+        while True:
+            length = f.readinto(buffer)
+            read_at = time.perf_counter()
+            timings.read_seconds += read_at - started_at
+            if not length:
+                break
+
+            state.update(buffer[:length])
+            started_at = time.perf_counter()
+            timings.hash_seconds += started_at - read_at
+            timings.bytes_read += length
+
+    return finish(state)
@@ -2,49 +2,213 @@
 
 import os
 import sys
-import pickle
 import argparse
-from binascii import crc32
-from functools import reduce
+import json
+import queue
+import re
+import time
+from collections import deque
+from concurrent import futures
 from hashlib import sha256
 from pathlib import Path
-from typing import Union
-from pprint import pprint
-
-# DiffDict = dict[str, Union[str, dict[str, str], list[str]]]
-DiffDict = dict[str, Union[str, list[str]]]
+from typing import Iterable, Iterator, NamedTuple, Optional
+from chunks import CHUNK_FILE_BYTES, Chunk, changed_ranges, hash_file_chunks
+from chunks import available as chunks_available
+from hashers import DEFAULT_HASHER, HASHERS, HASHERS_BY_ID, FileTimings, Hasher, finish, hash_file
+from snapshot import Record, SnapshotCursor, SnapshotReader, SnapshotWriter, StatKey, entry_name, parent_key, record_key
+from stats import ScanStats
+from store import DirectoryEntry, ObjectStore, StoredSnapshot, child_path
+
+try:
+    from watchdog.events import FileSystemEvent, FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEvent = FileSystemEventHandler = object
+    Observer = None
 
 STORAGE_PATH=Path("./storage").absolute()
 
-def crc32_file(path: str) -> int:
-    with open(path, 'rb') as f:
-        checksum = 0
-        while (chunk := f.read(1024)):
-            checksum = crc32(chunk, checksum)
-        return checksum
-
-def crc32_directory(path: str, file_sums: list[int]) -> int:
-    if not file_sums:
-        return crc32(bytes(path, 'utf-8'))
-    return reduce(lambda i, j: int(i) ^ int(j), file_sums)
-
-def to_hex(value: int) -> str:
-    return hex(value) # f"{value:#010x}"
-
-def sum_directory(path: str) -> dict[str, str]:
-    sums: dict[str, str] = {}
-    for root, dirs, files in os.walk(path):
-        root_file_sums = []
-
-        for file in files:
-            file_path = str(Path(root).joinpath(file))
-            crc32_sum = crc32_file(file_path)
-            sums[file_path] = to_hex(crc32_sum)
-
-            root_file_sums.append(crc32_sum)
-
-        sums[root] = to_hex(crc32_directory(root, root_file_sums))
-    return sums
+SCAN_BATCH_FILES = 64 # files hashed per worker task
+SCAN_WINDOW_TASKS = 4 # in-flight tasks per worker before the walk waits for results
+
+WATCH_SETTLE_SECONDS = 0.05 # events arriving within this time after the first one are handled together
+WATCH_CHECKPOINT_SECONDS = 60
+
+def directory_entry(path: str, is_dir: bool, checksum: int, width: int) -> bytes:
+    # one child of a directory in its merkle hash: kind, name and checksum, so renames,
+    # moves between directories and duplicated files all change the parent hash
+    name = entry_name(path).encode('utf-8', 'surrogateescape')
+    return (b"d" if is_dir else b"f") + name + b"\0" + checksum.to_bytes(width, 'little')
+
+def stat_key(path: str) -> StatKey:
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+def hash_path(
+    path: str,
+    hasher: Hasher,
+    size: int,
+    previous_record: Optional[Record],
+    chunk_bytes: Optional[int],
+    timings: Optional[FileTimings] = None,
+) -> tuple[int, Optional[tuple[Chunk, ...]]]:
+    # large files, and files that were chunked before, are also split into content defined chunks
+    chunked = chunk_bytes is not None and size >= chunk_bytes
+    chunked = chunked or (previous_record is not None and previous_record.chunks is not None)
+
+    if chunked and chunks_available():
+        return hash_file_chunks(path, hasher, timings)
+    return hash_file(path, hasher, timings), None
+
+def hash_files(
+    paths: list[str],
+    previous: list[Optional[Record]],
+    paranoid: bool,
+    hash_name: str,
+    chunk_bytes: Optional[int] = None,
+) -> tuple[list[tuple[StatKey, int, Optional[tuple[Chunk, ...]]]], FileTimings]:
+    hasher = HASHERS[hash_name]
+    timings = FileTimings()
+    results = []
+    for path, previous_record in zip(paths, previous):
+        started_at = time.perf_counter()
+        current_stat = stat_key(path)
+        timings.stat_seconds += time.perf_counter() - started_at
+
+        if not paranoid and previous_record is not None and previous_record.stat == current_stat:
+            results.append((current_stat, previous_record.checksum, previous_record.chunks))
+        else:
+            results.append((current_stat, *hash_path(path, hasher, current_stat[0], previous_record, chunk_bytes, timings)))
+
+    return results, timings
+
+def default_workers(use_processes: bool) -> int:
+    # same defaults as the executors, threads mostly wait on I/O so there are more of them
+    cpu_count = os.cpu_count() or 1
+    return cpu_count if use_processes else min(32, cpu_count + 4)
+
+def list_directory(path: str) -> tuple[list[str], list[str]]:
+    # same split as os.walk: symlinks to directories are neither walked nor hashed
+    files = []
+    dirs = []
+    try:
+        entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+    except OSError:
+        return files, dirs
+
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+
+        if not is_dir:
+            files.append(str(Path(path).joinpath(entry.name)))
+        elif not entry.is_symlink():
+            dirs.append(os.path.join(path, entry.name))
+
+    return files, dirs
+
+def walk_directory(path: str) -> Iterator[tuple[str, list[str], bool]]:
+    # yields (directory, files, False) when a directory is entered and (directory, [], True) once
+    # its whole subtree was yielded, which is the record_key order of the snapshot
+    files, dirs = list_directory(path)
+    yield path, files, False
+    stack = [(path, iter(dirs))]
+
+    while stack:
+        directory, sub_dirs = stack[-1]
+        sub_dir = next(sub_dirs, None)
+
+        if sub_dir is None:
+            stack.pop()
+            yield directory, [], True
+            continue
+
+        files, dirs = list_directory(sub_dir)
+        yield sub_dir, files, False
+        stack.append((sub_dir, iter(dirs)))
+
+def sum_directory(
+    path: str,
+    workers: Optional[int] = None,
+    use_processes: Optional[bool] = None,
+    previous: Optional[Iterable[Record]] = None,
+    paranoid: bool = False,
+    hasher: Hasher = DEFAULT_HASHER,
+    stats: Optional[ScanStats] = None,
+    chunk_bytes: Optional[int] = None,
+) -> Iterator[Record]:
+    # the walk keeps submitting batches while the pool hashes, records are yielded in walk
+    # order (record_key order) as soon as the batches in front of them are done
+    use_processes = hasher.cpu_heavy if use_processes is None else use_processes
+    workers = workers or default_workers(use_processes)
+    executor_class = futures.ProcessPoolExecutor if use_processes else futures.ThreadPoolExecutor
+    previous_cursor = SnapshotCursor(previous if previous is not None else [])
+
+    stats = stats if stats is not None else ScanStats()
+    pending: deque[tuple[str, bool, list[str], list[futures.Future], float]] = deque()
+    pending_tasks = 0
+    # [merkle hash state, records below] of every directory between the root and the walk
+    directory_frames: list[list] = []
+
+    def collect() -> Iterator[Record]:
+        directory, is_exit, file_paths, tasks, walk_seconds = pending.popleft()
+
+        if is_exit:
+            directory_state, descendants = directory_frames.pop()
+            directory_sum = finish(directory_state)
+            if directory_frames:
+                directory_frames[-1][0].update(directory_entry(directory, True, directory_sum, hasher.width))
+                directory_frames[-1][1] += descendants + 1
+
+            yield Record(directory, True, directory_sum, None, descendants)
+            return
+
+        results = []
+        timings = FileTimings()
+        for task in tasks:
+            task_results, task_timings = task.result()
+            results += task_results
+            timings.merge(task_timings)
+
+        stats.add_directory(directory, len(results), walk_seconds, timings)
+        directory_state = hasher.new()
+        for file_path, (file_stat, file_sum, file_chunks) in zip(file_paths, results):
+            directory_state.update(directory_entry(file_path, False, file_sum, hasher.width))
+            yield Record(file_path, False, file_sum, file_stat, 0, file_chunks)
+
+        directory_frames.append([directory_state, len(results)])
+
+    walk = walk_directory(path)
+    with executor_class(max_workers=workers) as executor:
+        while True:
+            started_at = time.perf_counter()
+            walked = next(walk, None)
+            walk_seconds = time.perf_counter() - started_at
+            if walked is None:
+                break
+
+            directory, file_paths, is_exit = walked
+            file_previous = [previous_cursor.seek(file_path) for file_path in file_paths]
+            tasks = [
+                executor.submit(
+                    hash_files, file_paths[i:i + SCAN_BATCH_FILES], file_previous[i:i + SCAN_BATCH_FILES], paranoid, hasher.name, chunk_bytes
+                )
+                for i in range(0, len(file_paths), SCAN_BATCH_FILES)
+            ]
+
+            pending.append((directory, is_exit, file_paths, tasks, walk_seconds))
+            pending_tasks += len(tasks)
+
+            while pending_tasks > workers * SCAN_WINDOW_TASKS:
+                pending_tasks -= len(pending[0][3])
+                yield from collect()
+
+        while pending:
+            yield from collect()
+
+    stats.finish()
 
 def get_project_storage_path(path: str) -> Path:
     project_hash = sha256(bytes(path, 'utf-8')).hexdigest()[:10]
@@ -59,90 +223,554 @@ def assert_directory_exists(path: str) -> None:
         print(f"------ {directory_path}")
         sys.exit(0)
 
-def diff_dicts(first: dict[str, str], second: dict[str, str]) -> DiffDict:
-    changed = []
-    deleted = []
-    inserted = []
-
-    for key in first:
-        if key not in second:
-            deleted.append(key)
-        elif first[key] != second[key]:
-            # changed[key] = {'from': first[key], 'to': second[key]} # use first DiffDict
-            changed.append(key)
-
-    for key in second:
-        if key not in first:
-            # inserted[key] = dict2[key]
-            inserted.append(key)
-
-    # may sort directory first
-    # changed.sort()
-    # deleted.sort()
-    # inserted.sort()
-
-    return {
-        'changed': changed,
-        'deleted': deleted,
-        'inserted': inserted
-    }
-
-def dump(project_path: str):
+def assert_hasher_available(hasher: Hasher) -> None:
+    try:
+        hasher.new()
+    except RuntimeError as error:
+        print(f"[Error] {error}")
+        sys.exit(0)
+
+class Change(NamedTuple):
+    event: str
+    path: str
+    ranges: Optional[list[tuple[int, int]]] = None # (offset, length) of changed bytes, chunked files only
+
+def changed_record(first: Record, second: Record) -> Change:
+    if first.chunks is None or second.chunks is None:
+        return Change('changed', second.path)
+    return Change('changed', second.path, changed_ranges(first.chunks, second.chunks))
+
+def diff_records(first: Iterable[Record], second: Iterable[Record]) -> Iterator[Change]:
+    # merge join of two record streams sorted by record_key, yields (event, path) as soon as
+    # both sides moved past a path, memory does not depend on the number of records
+    first_cursor = SnapshotCursor(first)
+    second_cursor = SnapshotCursor(second)
+
+    while first_cursor.current is not None or second_cursor.current is not None:
+        if second_cursor.current is None or (first_cursor.current is not None and first_cursor.current_key < second_cursor.current_key):
+            yield Change('deleted', first_cursor.current.path)
+            first_cursor.advance()
+        elif first_cursor.current is None or second_cursor.current_key < first_cursor.current_key:
+            yield Change('inserted', second_cursor.current.path)
+            second_cursor.advance()
+        else:
+            if first_cursor.current.checksum != second_cursor.current.checksum:
+                yield changed_record(first_cursor.current, second_cursor.current)
+            first_cursor.advance()
+            second_cursor.advance()
+
+def diff_snapshots(first: SnapshotReader, second: SnapshotReader) -> Iterator[Change]:
+    # top down over the merkle hashes, a directory with the same hash on both sides is skipped
+    # with its whole subtree, so the work follows the number of changes, not the number of files
+    def subtree(reader: SnapshotReader, index: int) -> Iterator[Record]:
+        for i in range(index - reader.record_at(index).descendants, index + 1):
+            yield reader.record_at(i)
+
+    def diff_directory(first_index: int, second_index: int) -> Iterator[Change]:
+        first_record = first.record_at(first_index)
+        second_record = second.record_at(second_index)
+        if first_record.checksum == second_record.checksum:
+            return
+
+        # (is_dir, name) sorts like the records, files first
+        first_children = {(child.is_dir, entry_name(child.path)): (i, child) for i, child in first.children(first_index)}
+        second_children = {(child.is_dir, entry_name(child.path)): (i, child) for i, child in second.children(second_index)}
+
+        for name in sorted(first_children.keys() | second_children.keys()):
+            if name not in second_children:
+                for record in subtree(first, first_children[name][0]):
+                    yield Change('deleted', record.path)
+            elif name not in first_children:
+                for record in subtree(second, second_children[name][0]):
+                    yield Change('inserted', record.path)
+            elif name[0]:
+                yield from diff_directory(first_children[name][0], second_children[name][0])
+            elif first_children[name][1].checksum != second_children[name][1].checksum:
+                yield changed_record(first_children[name][1], second_children[name][1])
+
+        yield Change('changed', second_record.path)
+
+    if len(first) and len(second):
+        yield from diff_directory(len(first) - 1, len(second) - 1)
+
+def diff_stored(store: ObjectStore, first: StoredSnapshot, second: StoredSnapshot) -> Iterator[Change]:
+    # same walk as diff_snapshots over the directory objects of two named snapshots, only the
+    # objects of changed directories are read
+    checksum_width = second.checksum_width
+
+    def diff_directory(first_entry: DirectoryEntry, second_entry: DirectoryEntry, path: str) -> Iterator[Change]:
+        if first_entry.checksum == second_entry.checksum:
+            return
+
+        first_children = {(child.is_dir, child.name): child for child in store.children(first_entry, checksum_width)}
+        second_children = {(child.is_dir, child.name): child for child in store.children(second_entry, checksum_width)}
+
+        for name in sorted(first_children.keys() | second_children.keys()):
+            if name not in second_children:
+                child = first_children[name]
+                for record in store.subtree(child, child_path(path, child), checksum_width):
+                    yield Change('deleted', record.path)
+            elif name not in first_children:
+                child = second_children[name]
+                for record in store.subtree(child, child_path(path, child), checksum_width):
+                    yield Change('inserted', record.path)
+            elif name[0]:
+                yield from diff_directory(first_children[name], second_children[name], child_path(path, second_children[name]))
+            elif first_children[name].checksum != second_children[name].checksum:
+                yield Change('changed', child_path(path, second_children[name]))
+
+        yield Change('changed', path)
+
+    yield from diff_directory(first.root, second.root, second.path)
+
+class WatchState:
+    # the latest record of every file and directory below the root, updated from file system
+    # events and turned back into snapshot records (with merkle hashes) on every checkpoint
+    def __init__(self, root: str, hasher: Hasher, paranoid: bool = False, chunk_bytes: Optional[int] = None) -> None:
+        self.root = root
+        self.hasher = hasher
+        self.paranoid = paranoid
+        self.chunk_bytes = chunk_bytes
+        self.files: dict[str, Record] = {}
+        self.dirs: set[str] = set()
+        self.dirty = False
+
+    def add(self, record: Record) -> None:
+        if record.is_dir:
+            self.dirs.add(record.path)
+        else:
+            self.files[record.path] = record
+
+    def remove_tree(self, path: str) -> Iterator[Change]:
+        # file records are Path normalized while directory records keep the os.path.join form
+        file_prefix = str(Path(path)) + os.sep
+        dir_prefix = path + os.sep
+
+        removed = [record for file_path, record in self.files.items() if file_path.startswith(file_prefix)]
+        removed += [Record(dir_path, True, 0) for dir_path in self.dirs if dir_path.startswith(dir_prefix) or dir_path == path]
+
+        for record in sorted(removed, key=record_key):
+            if record.is_dir:
+                self.dirs.discard(record.path)
+            else:
+                del self.files[record.path]
+            yield Change('deleted', record.path)
+
+    def refresh(self, path: str) -> Iterator[Change]:
+        # re-checks one path that an event touched, only a file whose stat changed is hashed again
+        path = os.path.normpath(path)
+        if os.path.isdir(path):
+            if not os.path.islink(path) and path not in self.dirs:
+                for record in sum_directory(path, previous=[], hasher=self.hasher, chunk_bytes=self.chunk_bytes):
+                    self.add(record)
+                    self.dirty = True
+                    yield Change('inserted', record.path)
+            return
+
+        file_path = str(Path(path))
+        previous = self.files.get(file_path)
+        try:
+            current_stat = stat_key(path)
+            if previous is not None and previous.stat == current_stat and not self.paranoid:
+                return
+
+            checksum, chunks = hash_path(path, self.hasher, current_stat[0], previous, self.chunk_bytes)
+            record = Record(file_path, False, checksum, current_stat, 0, chunks)
+        except OSError:
+            record = None
+
+        if path in self.dirs:
+            self.dirty = True
+            yield from self.remove_tree(path)
+
+        if record is None:
+            if previous is not None:
+                del self.files[file_path]
+                self.dirty = True
+                yield Change('deleted', file_path)
+            return
+
+        self.files[file_path] = record
+        self.dirty = True
+        if previous is None:
+            yield Change('inserted', file_path)
+        elif previous.checksum != record.checksum:
+            yield changed_record(previous, record)
+
+    def records(self) -> Iterator[Record]:
+        # same records and merkle hashes as sum_directory: in record_key order the files of a
+        # directory come first, then its sub directories as they close, then the directory itself
+        entries = sorted([*self.files.values(), *(Record(path, True, 0) for path in self.dirs)], key=record_key)
+        frames: dict[str, list] = {}
+
+        for entry in entries:
+            key = os.path.normpath(entry.path)
+            parent = frames.setdefault(parent_key(key), [self.hasher.new(), 0])
+
+            if not entry.is_dir:
+                parent[0].update(directory_entry(entry.path, False, entry.checksum, self.hasher.width))
+                parent[1] += 1
+                yield entry
+                continue
+
+            directory_state, descendants = frames.pop(key, None) or (self.hasher.new(), 0)
+            directory_sum = finish(directory_state)
+            if key != os.path.normpath(self.root):
+                parent[0].update(directory_entry(entry.path, True, directory_sum, self.hasher.width))
+                parent[1] += descendants + 1
+
+            yield Record(entry.path, True, directory_sum, None, descendants)
+
+    def checkpoint(self, snapshot_path: Path) -> None:
+        with SnapshotWriter(snapshot_path, self.hasher.width, self.hasher.id) as writer:
+            for record in self.records():
+                writer.add(record)
+
+        self.dirty = False
+
+class WatchHandler(FileSystemEventHandler):
+    # runs on the observer thread, only queues the touched paths for the watch loop
+    def __init__(self, paths: queue.Queue) -> None:
+        super().__init__()
+        self.paths = paths
+
+    def on_any_event(self, event: FileSystemEvent) -> None:
+        if event.event_type in ('opened', 'closed_no_write'):
+            return
+
+        self.paths.put(os.fsdecode(event.src_path))
+        if event.dest_path:
+            self.paths.put(os.fsdecode(event.dest_path))
+
+def print_event(change: Change, as_json: bool = False) -> None:
+    # one line per event, JSON lines for tools that read the output as a stream
+    if as_json:
+        line = {'event': change.event, 'path': change.path}
+        if change.ranges is not None:
+            line['ranges'] = [{'offset': offset, 'length': length} for offset, length in change.ranges]
+        print(json.dumps(line), flush=True)
+    elif change.ranges:
+        ranges = ", ".join(f"{offset}-{offset + length - 1}" for offset, length in change.ranges)
+        print(f"[{change.event}] {change.path} (bytes {ranges})", flush=True)
+    else:
+        print(f"[{change.event}] {change.path}", flush=True)
+
+def open_snapshot(snapshot_path: Path) -> SnapshotReader:
+    snapshot = SnapshotReader(snapshot_path)
+    if snapshot.hash_algorithm not in HASHERS_BY_ID:
+        print("[Error] Snapshot file uses an unknown hash algorithm")
+        print(f"------ {snapshot_path.absolute()} (algorithm id: {snapshot.hash_algorithm})")
+        sys.exit(0)
+    return snapshot
+
+def assert_snapshot_name(name: str) -> None:
+    if not re.fullmatch(r"[\w-][\w.-]*", name):
+        print("[Error] Snapshot name may only contain letters, digits, dots, dashes and underscores")
+        print(f"------ {name}")
+        sys.exit(0)
+
+def load_stored_snapshot(store: ObjectStore, name: str) -> StoredSnapshot:
+    assert_snapshot_name(name)
+
+    if not store.snapshot_path(name).exists():
+        print("[Error] Named snapshot does not exists, Please use `--dump --save` to create it first")
+        print(f"------ {store.snapshot_path(name)}")
+        sys.exit(0)
+
+    return store.load(name)
+
+def dump(
+    project_path: str,
+    workers: Optional[int] = None,
+    use_processes: Optional[bool] = None,
+    paranoid: bool = False,
+    hash_name: Optional[str] = None,
+    save_name: Optional[str] = None,
+    stats: Optional[ScanStats] = None,
+    chunk_bytes: Optional[int] = None,
+):
     assert_directory_exists(project_path)
 
     project_storage_path = get_project_storage_path(project_path)
-    project_default_sum_path = project_storage_path.joinpath('sum-default.pickle')
+    project_default_sum_path = project_storage_path.joinpath('sum-default.snapshot')
+    hasher = HASHERS[hash_name] if hash_name else DEFAULT_HASHER
+    assert_hasher_available(hasher)
+
+    store = ObjectStore(project_storage_path)
+    if save_name is not None:
+        assert_snapshot_name(save_name)
+        if store.snapshot_path(save_name).exists():
+            print("[Error] Named snapshot already exists")
+            print(f"------ {store.snapshot_path(save_name)}")
+            sys.exit(0)
 
     if not project_storage_path.exists():
         project_storage_path.mkdir()
 
-    checksums = sum_directory(project_path)
-    checksum_data = pickle.dumps(checksums)
+    previous = open_snapshot(project_default_sum_path) if project_default_sum_path.exists() else None
+
+    # stored checksums can only be reused when they were made by the same algorithm
+    if previous is not None and previous.hash_algorithm != hasher.id:
+        previous.close()
+        previous = None
 
-    with open(project_default_sum_path, 'wb+') as f:
-        f.write(checksum_data)
+    # records go to the snapshot while the scan is still running
+    tree_writer = store.writer(project_path, hasher.width) if save_name is not None else None
+    with SnapshotWriter(project_default_sum_path, hasher.width, hasher.id) as writer:
+        for record in sum_directory(project_path, workers, use_processes, previous, paranoid, hasher, stats, chunk_bytes):
+            writer.add(record)
+            if tree_writer is not None:
+                tree_writer.add(record)
 
-    with open(project_default_sum_path, 'rb') as f:
-        pickle.loads(f.read())
+    if previous is not None:
+        previous.close()
 
     print("[OK] Target directory dump succeeded")
     print(f"---- {project_storage_path}")
 
-def diff(project_path: str):
+    if tree_writer is not None:
+        tree_writer.close(save_name, hasher.id)
+        shared_objects = tree_writer.objects - tree_writer.new_objects
+        print(f"[OK] Named snapshot {save_name} saved, {tree_writer.new_objects} new directory objects, {shared_objects} shared with older snapshots")
+
+def saved(project_path: str):
+    store = ObjectStore(get_project_storage_path(project_path))
+    names = store.names()
+
+    if not names:
+        print("[Error] No named snapshots yet, Please use `--dump --save` to create one first")
+        sys.exit(0)
+
+    for name in names:
+        snapshot = store.load(name)
+        created_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot.created_at))
+        hasher_name = HASHERS_BY_ID[snapshot.hash_algorithm].name
+        print(f"{name:<24} {created_at}  {snapshot.root.descendants + 1:>10,} records  {hasher_name:<8} {snapshot.root.object_id[:12]}")
+
+    object_count, object_bytes = store.usage()
+    print(f"---- {object_count:,} directory objects, {object_bytes:,} bytes")
+
+def diff_saved(project_path: str, first_name: str, second_name: str, as_json: bool = False):
+    store = ObjectStore(get_project_storage_path(project_path))
+    first = load_stored_snapshot(store, first_name)
+    second = load_stored_snapshot(store, second_name)
+
+    if first.hash_algorithm != second.hash_algorithm:
+        first_hasher = HASHERS_BY_ID[first.hash_algorithm].name
+        second_hasher = HASHERS_BY_ID[second.hash_algorithm].name
+        print(f"[Error] Named snapshots use different hash algorithms ({first_hasher} and {second_hasher})")
+        sys.exit(0)
+
+    for change in diff_stored(store, first, second):
+        print_event(change, as_json)
+
+def diff(
+    project_path: str,
+    workers: Optional[int] = None,
+    use_processes: Optional[bool] = None,
+    paranoid: bool = False,
+    hash_name: Optional[str] = None,
+    stats: Optional[ScanStats] = None,
+    as_json: bool = False,
+    chunk_bytes: Optional[int] = None,
+):
     assert_directory_exists(project_path)
 
     project_storage_path = get_project_storage_path(project_path)
-    project_default_sum_path = project_storage_path.joinpath('sum-default.pickle')
+    project_default_sum_path = project_storage_path.joinpath('sum-default.snapshot')
 
     if not project_default_sum_path.exists():
         print("[Error] Missing checksum file in target directory, Please use `--dump` to create default checksum file first")
         print(f"------ {project_default_sum_path}")
         sys.exit(0)
 
-    default_sum_file = open(project_default_sum_path, 'rb')
-    default_checksums = pickle.loads(default_sum_file.read())
-    default_sum_file.close()
+    with open_snapshot(project_default_sum_path) as default_snapshot:
+        hasher = HASHERS_BY_ID[default_snapshot.hash_algorithm]
+
+        if hash_name and hash_name != hasher.name:
+            print(f"[Error] Checksum file was dumped with {hasher.name}, it can not be diffed with {hash_name}")
+            print(f"------ {project_default_sum_path}")
+            sys.exit(0)
+
+        assert_hasher_available(hasher)
+
+        # files whose size, mtime, inode and device did not change keep their stored checksum,
+        # files that were chunked in the checksum file are chunked again to find the changed bytes
+        current_records = sum_directory(project_path, workers, use_processes, default_snapshot, paranoid, hasher, stats, chunk_bytes)
+
+        for change in diff_records(default_snapshot, current_records):
+            print_event(change, as_json)
+
+def compare(first_path: str, second_path: str, as_json: bool = False):
+    for snapshot_path in (first_path, second_path):
+        if not Path(snapshot_path).exists():
+            print("[Error] Snapshot file does not exists")
+            print(f"------ {Path(snapshot_path).absolute()}")
+            sys.exit(0)
+
+    with open_snapshot(Path(first_path)) as first, open_snapshot(Path(second_path)) as second:
+        if first.hash_algorithm != second.hash_algorithm:
+            first_name = HASHERS_BY_ID[first.hash_algorithm].name
+            second_name = HASHERS_BY_ID[second.hash_algorithm].name
+            print(f"[Error] Snapshot files use different hash algorithms ({first_name} and {second_name})")
+            sys.exit(0)
+
+        for change in diff_snapshots(first, second):
+            print_event(change, as_json)
+
+def watch(
+    project_path: str,
+    workers: Optional[int] = None,
+    use_processes: Optional[bool] = None,
+    paranoid: bool = False,
+    hash_name: Optional[str] = None,
+    checkpoint_seconds: float = WATCH_CHECKPOINT_SECONDS,
+    stats: Optional[ScanStats] = None,
+    as_json: bool = False,
+    chunk_bytes: Optional[int] = None,
+):
+    assert_directory_exists(project_path)
 
-    current_checksums = sum_directory(project_path)
+    if Observer is None:
+        print("[Error] Watch mode needs the watchdog package, run `make vendor` first")
+        sys.exit(0)
 
-    diff_checksums = diff_dicts(default_checksums, current_checksums)
+    project_storage_path = get_project_storage_path(project_path)
+    project_default_sum_path = project_storage_path.joinpath('sum-default.snapshot')
 
-    pprint(diff_checksums)
-    pass
+    if not project_storage_path.exists():
+        project_storage_path.mkdir()
+
+    # the storage path follows the path as given like --dump and --diff, the tree is watched by
+    # its normalized path since watchdog reports parent directories without a trailing slash
+    project_path = os.path.normpath(project_path)
+
+    previous = open_snapshot(project_default_sum_path) if project_default_sum_path.exists() else None
+    if hash_name:
+        hasher = HASHERS[hash_name]
+    elif previous is not None:
+        hasher = HASHERS_BY_ID[previous.hash_algorithm]
+    else:
+        hasher = DEFAULT_HASHER
+    assert_hasher_available(hasher)
+
+    if previous is not None and previous.hash_algorithm != hasher.id:
+        previous.close()
+        previous = None
+
+    # subscribe before the initial scan, changes made while it runs are re-checked afterwards
+    paths: queue.Queue = queue.Queue()
+    observer = Observer()
+    observer.schedule(WatchHandler(paths), project_path, recursive=True)
+    observer.start()
+
+    state = WatchState(project_path, hasher, paranoid, chunk_bytes)
+
+    def scanned_records() -> Iterator[Record]:
+        for record in sum_directory(project_path, workers, use_processes, previous, paranoid, hasher, stats, chunk_bytes):
+            state.add(record)
+            yield record
+
+    # first report what changed since the stored snapshot, like --diff
+    if previous is not None:
+        for change in diff_records(previous, scanned_records()):
+            print_event(change, as_json)
+        previous.close()
+    else:
+        for _ in scanned_records():
+            pass
+
+    state.checkpoint(project_default_sum_path)
+    next_checkpoint = time.monotonic() + checkpoint_seconds
+
+    print("[OK] Watching target directory, press Ctrl+C to stop", flush=True)
+    print(f"---- {project_default_sum_path}", flush=True)
+
+    try:
+        while True:
+            try:
+                touched = {paths.get(timeout=max(0, next_checkpoint - time.monotonic()))}
+                time.sleep(WATCH_SETTLE_SECONDS)
+                while not paths.empty():
+                    touched.add(paths.get_nowait())
+            except queue.Empty:
+                touched = set()
+
+            # parents first, a new directory is scanned once and its files then look unchanged
+            for touched_path in sorted(touched, key=len):
+                for change in state.refresh(touched_path):
+                    print_event(change, as_json)
+
+            if time.monotonic() >= next_checkpoint:
+                if state.dirty:
+                    state.checkpoint(project_default_sum_path)
+                next_checkpoint = time.monotonic() + checkpoint_seconds
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        observer.join()
+
+        if state.dirty:
+            state.checkpoint(project_default_sum_path)
 
 def main():
     raise ValueError('[ERROR] Unknown command action')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-p", "--path", help="target directory path", type=str, required=True)
+    parser.add_argument("-p", "--path", help="target directory path", type=str)
     parser.add_argument("--dump", help="dump the checksums of directory", action="store_true")
     parser.add_argument("--diff", help="diff the checksums of directory", action="store_true")
+    parser.add_argument("--save", help="with --dump, also keep the checksums as a named snapshot (default name: current time)", nargs="?", const="", default=None, metavar="NAME")
+    parser.add_argument("--saved", help="list the named snapshots of directory", action="store_true")
+    parser.add_argument("--diff-saved", help="diff two named snapshots of directory without scanning", nargs=2, metavar=("FIRST", "SECOND"))
+    parser.add_argument("--watch", help="diff once, then keep reporting changes until Ctrl+C", action="store_true")
+    parser.add_argument("--checkpoint", help="seconds between snapshot writes in watch mode (default: 60)", type=float, default=WATCH_CHECKPOINT_SECONDS)
+    parser.add_argument("--compare", help="diff two snapshot files without scanning", nargs=2, metavar=("FIRST", "SECOND"))
+    parser.add_argument("--workers", help="number of hashing workers (default: cpu count based)", type=int, default=None)
+    parser.add_argument("--processes", help="hash in worker processes (default for cpu heavy hashes)", action="store_true")
+    parser.add_argument("--threads", help="hash in worker threads (default for crc32 and xxhash)", action="store_true")
+    parser.add_argument("--hash", help="hash algorithm (default: crc32 for --dump, the dumped one for --diff)", choices=HASHERS, default=None)
+    parser.add_argument("--paranoid", help="re-hash every file even if its stat is unchanged", action="store_true")
+    parser.add_argument("--chunks", help=f"split files of {CHUNK_FILE_BYTES >> 20} MiB and more into content defined chunks and report the changed byte ranges", action="store_true")
+    parser.add_argument("--json", help="print diff events as JSON lines", action="store_true")
+    parser.add_argument("--progress", help="show a live progress line on stderr while scanning", action="store_true")
+    parser.add_argument("--stats", help="print throughput, time split and slowest directories on stderr after scanning", action="store_true")
+    parser.add_argument("--stats-json", help="write the scan statistics to this JSON file", type=str, default=None, metavar="FILE")
     args = parser.parse_args()
 
-    if args.dump:
-        dump(args.path)
+    if (args.dump or args.diff or args.watch or args.saved or args.diff_saved) and args.path is None:
+        parser.error("the following arguments are required: -p/--path")
+
+    if args.save is not None and not args.dump:
+        parser.error("argument --save: only allowed with --dump")
+
+    use_processes = True if args.processes else False if args.threads else None
+    save_name = (args.save or time.strftime('%Y%m%d-%H%M%S')) if args.save is not None else None
+    stats = ScanStats(args.progress)
+    chunk_bytes = CHUNK_FILE_BYTES if args.chunks else None
+
+    if args.chunks and not chunks_available():
+        print("[Error] Chunked hashing needs the numpy package, run `make vendor` first")
+        sys.exit(0)
+
+    if args.compare:
+        compare(*args.compare, as_json=args.json)
+    elif args.dump:
+        dump(args.path, args.workers, use_processes, args.paranoid, args.hash, save_name, stats, chunk_bytes)
     elif args.diff:
-        diff(args.path)
+        diff(args.path, args.workers, use_processes, args.paranoid, args.hash, stats, args.json, chunk_bytes)
+    elif args.saved:
+        saved(args.path)
+    elif args.diff_saved:
+        diff_saved(args.path, *args.diff_saved, as_json=args.json)
+    elif args.watch:
+        watch(args.path, args.workers, use_processes, args.paranoid, args.hash, args.checkpoint, stats, args.json, chunk_bytes)
     else:
         main()
+
+    if args.stats:
+        stats.report()
+    if args.stats_json:
+        stats.write_json(args.stats_json)
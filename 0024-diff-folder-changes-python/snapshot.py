@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional, Self
+
+# file layout (little-endian)
+#
+#   header  : magic(4) version(u16) checksum_width(u8) hash_algorithm(u8, Hasher.id)
+#   blocks  : BLOCK_RECORDS records each, path prefix compression restarts at every block
+#   record  : shared_length(varint) suffix_length(varint) suffix(utf-8) kind(u8) checksum(checksum_width)
+#             [files only] size(u64) mtime_ns(i64) inode(u64) device(u64)
+#             [chunked files only] chunk_count(varint) then per chunk length(varint) checksum(checksum_width)
+#             [directories only] descendants(varint)
+#   index   : per block offset(u64) first_kind(u8) first_path_length(varint) first_path(utf-8)
+#   trailer : index_offset(u64) block_count(u64) record_count(u64) magic(4)
+#
+# records are sorted by record_key: inside every directory its files come first (by name),
+# then the subtrees of its sub directories (by name), then the record of the directory itself,
+# so a scan can emit a directory as soon as everything below it is known. The subtree of the
+# directory record at index i is the `descendants` records right before it
+SNAPSHOT_MAGIC = b"DFSN"
+SNAPSHOT_INDEX_MAGIC = b"DFSI"
+SNAPSHOT_VERSION = 4
+SNAPSHOT_READ_VERSIONS = (3, 4) # version 4 added chunked files
+SNAPSHOT_HEADER = struct.Struct("<4sHBB")
+SNAPSHOT_TRAILER = struct.Struct("<QQQ4s")
+SNAPSHOT_STAT = struct.Struct("<QqQQ")
+SNAPSHOT_INDEX_ENTRY = struct.Struct("<QB")
+
+BLOCK_RECORDS = 1024
+WRITE_BUFFER_BYTES = 1 << 20
+
+KIND_FILE = 0
+KIND_DIRECTORY = 1
+KIND_CHUNKED_FILE = 2
+
+StatKey = tuple[int, int, int, int]
+
+class Record(NamedTuple):
+    path: str
+    is_dir: bool
+    checksum: int
+    stat: Optional[StatKey] = None
+    descendants: int = 0
+    chunks: Optional[tuple[tuple[int, int], ...]] = None # (length, checksum) of the content defined chunks
+
+RecordKey = tuple[tuple, ...]
+
+@lru_cache(maxsize=4096)
+def directory_steps(path: str) -> RecordKey:
+    return tuple((1, part) for part in Path(path).parts)
+
+def path_key(path: str, is_dir: bool) -> RecordKey:
+    if is_dir:
+        return directory_steps(path) + ((2,),)
+
+    directory, name = os.path.split(path)
+    return directory_steps(directory) + ((0, name),)
+
+def record_key(record: Record) -> RecordKey:
+    return path_key(record.path, record.is_dir)
+
+def entry_name(path: str) -> str:
+    return os.path.basename(os.path.normpath(path))
+
+def parent_key(path: str) -> str:
+    # normalized parent directory, the entries of "." have "" as dirname but belong to "."
+    return os.path.dirname(os.path.normpath(path)) or os.curdir
+
+def encode_path(path: str) -> bytes:
+    return path.encode('utf-8', 'surrogateescape')
+
+def decode_path(data: bytes) -> str:
+    return data.decode('utf-8', 'surrogateescape')
+
+def encode_varint(value: int) -> bytes:
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+def decode_varint(data: bytes, offset: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def shared_prefix_length(first: bytes, second: bytes) -> int:
+    length = min(len(first), len(second))
+    for i in range(length):
+        if first[i] != second[i]:
+            return i
+    return length
+
+class SnapshotWriter:
+    # records must be added in record_key order, the file is written to a temporary path and
+    # renamed into place on close so a reader never sees a half written snapshot
+    def __init__(self: Self, path: Path, checksum_width: int = 4, hash_algorithm: int = 0) -> None:
+        self.path = Path(path)
+        self.temporary_path = self.path.with_name(self.path.name + '.tmp')
+        self.checksum_width = checksum_width
+        self.hash_algorithm = hash_algorithm
+        self.file = open(self.temporary_path, 'wb', buffering=WRITE_BUFFER_BYTES)
+        self.file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, checksum_width, hash_algorithm))
+
+        self.index: list[tuple[int, bool, bytes]] = []
+        self.record_count = 0
+        self.last_path = b""
+        self.last_key: Optional[RecordKey] = None
+
+    def __enter__(self: Self) -> Self:
+        return self
+
+    def __exit__(self: Self, error_type, *args) -> None:
+        if error_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.unlink(self.temporary_path)
+
+    def add(self: Self, record: Record) -> None:
+        key = record_key(record)
+        if self.last_key is not None and key <= self.last_key:
+            raise ValueError(f"Snapshot records must be sorted by record key: {record.path}")
+
+        path = encode_path(record.path)
+        if self.record_count % BLOCK_RECORDS == 0:
+            self.index.append((self.file.tell(), record.is_dir, path))
+            shared = 0
+        else:
+            shared = shared_prefix_length(self.last_path, path)
+
+        data = bytearray(encode_varint(shared))
+        data += encode_varint(len(path) - shared)
+        data += path[shared:]
+        if record.is_dir:
+            data.append(KIND_DIRECTORY)
+        else:
+            data.append(KIND_FILE if record.chunks is None else KIND_CHUNKED_FILE)
+        data += record.checksum.to_bytes(self.checksum_width, 'little')
+        if record.is_dir:
+            data += encode_varint(record.descendants)
+        else:
+            data += SNAPSHOT_STAT.pack(*record.stat)
+
+        if record.chunks is not None:
+            data += encode_varint(len(record.chunks))
+            for length, checksum in record.chunks:
+                data += encode_varint(length) + checksum.to_bytes(self.checksum_width, 'little')
+
+        self.file.write(data)
+        self.record_count += 1
+        self.last_path = path
+        self.last_key = key
+
+    def close(self: Self) -> None:
+        index_offset = self.file.tell()
+        for offset, is_dir, first_path in self.index:
+            kind = KIND_DIRECTORY if is_dir else KIND_FILE
+            self.file.write(SNAPSHOT_INDEX_ENTRY.pack(offset, kind) + encode_varint(len(first_path)) + first_path)
+
+        self.file.write(SNAPSHOT_TRAILER.pack(index_offset, len(self.index), self.record_count, SNAPSHOT_INDEX_MAGIC))
+        self.file.close()
+        os.replace(self.temporary_path, self.path)
+
+class SnapshotReader:
+    # only the block index is kept in memory, records are decoded one block at a time
+    def __init__(self: Self, path: Path) -> None:
+        self.path = Path(path)
+        self.file = open(self.path, 'rb')
+
+        magic, version, self.checksum_width, self.hash_algorithm = SNAPSHOT_HEADER.unpack(self.file.read(SNAPSHOT_HEADER.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"Not a snapshot file: {self.path}")
+        if version not in SNAPSHOT_READ_VERSIONS:
+            raise ValueError(f"Unsupported snapshot version: {version}")
+
+        self.file.seek(-SNAPSHOT_TRAILER.size, os.SEEK_END)
+        self.index_offset, block_count, self.record_count, magic = SNAPSHOT_TRAILER.unpack(self.file.read(SNAPSHOT_TRAILER.size))
+        if magic != SNAPSHOT_INDEX_MAGIC:
+            raise ValueError(f"Truncated snapshot file: {self.path}")
+
+        self.cached_block = -1
+        self.cached_records: list[Record] = []
+
+        self.file.seek(self.index_offset)
+        index_data = self.file.read()
+        self.block_offsets: list[int] = []
+        offset = 0
+        for _ in range(block_count):
+            block_offset, _ = SNAPSHOT_INDEX_ENTRY.unpack_from(index_data, offset)
+            length, offset = decode_varint(index_data, offset + SNAPSHOT_INDEX_ENTRY.size)
+            self.block_offsets.append(block_offset)
+            offset += length
+
+    def __enter__(self: Self) -> Self:
+        return self
+
+    def __exit__(self: Self, *args) -> None:
+        self.close()
+
+    def __len__(self: Self) -> int:
+        return self.record_count
+
+    def __iter__(self: Self) -> Iterator[Record]:
+        for block in range(len(self.block_offsets)):
+            yield from self.read_block(block)
+
+    def read_block(self: Self, block: int) -> list[Record]:
+        start = self.block_offsets[block]
+        end = self.block_offsets[block + 1] if block + 1 < len(self.block_offsets) else self.index_offset
+        self.file.seek(start)
+        data = self.file.read(end - start)
+
+        records = []
+        offset = 0
+        path = b""
+        while offset < len(data):
+            shared, offset = decode_varint(data, offset)
+            length, offset = decode_varint(data, offset)
+            path = path[:shared] + data[offset:offset + length]
+            offset += length
+
+            kind = data[offset]
+            is_dir = kind == KIND_DIRECTORY
+            checksum = int.from_bytes(data[offset + 1:offset + 1 + self.checksum_width], 'little')
+            offset += 1 + self.checksum_width
+
+            stat = None
+            descendants = 0
+            chunks = None
+            if is_dir:
+                descendants, offset = decode_varint(data, offset)
+            else:
+                stat = SNAPSHOT_STAT.unpack_from(data, offset)
+                offset += SNAPSHOT_STAT.size
+
+            if kind == KIND_CHUNKED_FILE:
+                chunk_count, offset = decode_varint(data, offset)
+                chunks = []
+                for _ in range(chunk_count):
+                    length, offset = decode_varint(data, offset)
+                    chunks.append((length, int.from_bytes(data[offset:offset + self.checksum_width], 'little')))
+                    offset += self.checksum_width
+                chunks = tuple(chunks)
+
+            records.append(Record(decode_path(path), is_dir, checksum, stat, descendants, chunks))
+
+        return records
+
+    def record_at(self: Self, index: int) -> Record:
+        # tree walks jump back and forth inside a few blocks, keep the last one decoded
+        block = index // BLOCK_RECORDS
+        if self.cached_block != block:
+            self.cached_records = self.read_block(block)
+            self.cached_block = block
+
+        return self.cached_records[index % BLOCK_RECORDS]
+
+    def children(self: Self, index: int) -> list[tuple[int, Record]]:
+        # walking back from a directory record, every step lands on the record of a child,
+        # a child directory is skipped over together with its subtree
+        start = index - self.record_at(index).descendants
+        children = []
+        index -= 1
+        while index >= start:
+            child = self.record_at(index)
+            children.append((index, child))
+            index -= 1 + child.descendants
+
+        children.reverse()
+        return children
+
+    def close(self: Self) -> None:
+        self.file.close()
+
+class SnapshotCursor:
+    # forward only lookups over records sorted by record_key, for callers that ask in the same order
+    def __init__(self: Self, records: Iterable[Record]) -> None:
+        self.records = iter(records)
+        self.advance()
+
+    def advance(self: Self) -> None:
+        self.current = next(self.records, None)
+        self.current_key = None if self.current is None else record_key(self.current)
+
+    def seek(self: Self, path: str, is_dir: bool = False) -> Optional[Record]:
+        key = path_key(path, is_dir)
+        while self.current_key is not None and self.current_key < key:
+            self.advance()
+
+        return self.current if self.current_key == key else None
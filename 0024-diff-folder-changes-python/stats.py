@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import heapq
+import json
+import sys
+import time
+from typing import Any, Self, TextIO
+from hashers import FileTimings
+
+SLOWEST_DIRECTORIES = 10
+PROGRESS_INTERVAL_SECONDS = 0.2
+
+class ScanStats:
+    # counters of one sum_directory run, stat/read/hash seconds are summed over all workers so
+    # with more than one worker they can add up to more than the elapsed time
+    def __init__(self: Self, progress: bool = False, stream: TextIO = sys.stderr) -> None:
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+        self.directories = 0
+        self.files = 0
+        self.walk_seconds = 0.0
+        self.timings = FileTimings()
+        self.slowest: list[tuple[float, int, str]] = [] # min heap of (seconds, files, directory)
+
+        self.progress = progress
+        self.progress_at = 0.0
+        self.stream = stream
+
+    def add_directory(self: Self, path: str, files: int, walk_seconds: float, timings: FileTimings) -> None:
+        # the time of a directory is listing it plus stat, read and hash of its own files
+        self.directories += 1
+        self.files += files
+        self.walk_seconds += walk_seconds
+        self.timings.merge(timings)
+
+        entry = (walk_seconds + timings.seconds(), files, path)
+        if len(self.slowest) < SLOWEST_DIRECTORIES:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+        if self.progress:
+            self.show_progress(path)
+
+    def elapsed(self: Self) -> float:
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def files_per_second(self: Self) -> float:
+        return self.files / max(self.elapsed(), 1e-9)
+
+    def megabytes_per_second(self: Self) -> float:
+        return self.timings.bytes_read / (1 << 20) / max(self.elapsed(), 1e-9)
+
+    def show_progress(self: Self, path: str) -> None:
+        now = time.perf_counter()
+        if now - self.progress_at < PROGRESS_INTERVAL_SECONDS:
+            return
+
+        self.progress_at = now
+        line = (
+            f"{self.files:,} files, {self.directories:,} dirs, "
+            f"{self.files_per_second():,.0f} files/s, {self.megabytes_per_second():,.1f} MB/s  {path}"
+        )
+        self.stream.write("\r\x1b[K" + line[:160])
+        self.stream.flush()
+
+    def finish(self: Self) -> None:
+        self.finished_at = time.perf_counter()
+        if self.progress:
+            self.stream.write("\r\x1b[K")
+            self.stream.flush()
+
+    def to_dict(self: Self) -> dict[str, Any]:
+        return {
+            'elapsed_seconds'     : self.elapsed(),
+            'directories'         : self.directories,
+            'files'               : self.files,
+            'hashed_files'        : self.timings.hashed_files,
+            'reused_files'        : self.files - self.timings.hashed_files,
+            'bytes_read'          : self.timings.bytes_read,
+            'files_per_second'    : self.files_per_second(),
+            'megabytes_per_second': self.megabytes_per_second(),
+            'walk_seconds'        : self.walk_seconds,
+            'stat_seconds'        : self.timings.stat_seconds,
+            'read_seconds'        : self.timings.read_seconds,
+            'hash_seconds'        : self.timings.hash_seconds,
+            'slowest_directories' : [
+                {'path': path, 'seconds': seconds, 'files': files}
+                for seconds, files, path in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+    def report(self: Self, stream: TextIO = sys.stderr) -> None:
+        stats = self.to_dict()
+        print(f"[Stats] {stats['files']:,} files in {stats['directories']:,} directories, {stats['elapsed_seconds']:.2f}s", file=stream)
+        print(f"------- {stats['files_per_second']:,.0f} files/s, {stats['megabytes_per_second']:,.1f} MB/s, "
+              f"{stats['hashed_files']:,} hashed, {stats['reused_files']:,} reused by stat", file=stream)
+        print(f"------- walk {stats['walk_seconds']:.2f}s, stat {stats['stat_seconds']:.2f}s, "
+              f"read {stats['read_seconds']:.2f}s, hash {stats['hash_seconds']:.2f}s (worker seconds)", file=stream)
+        for directory in stats['slowest_directories']:
+            print(f"------- {directory['seconds']:8.3f}s {directory['files']:>7,} files  {directory['path']}", file=stream)
+
+    def write_json(self: Self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
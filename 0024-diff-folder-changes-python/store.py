@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+from hashlib import sha256
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional, Self
+from snapshot import KIND_DIRECTORY, KIND_FILE, SNAPSHOT_STAT, Record, StatKey, decode_path, decode_varint, encode_path, encode_varint, entry_name, parent_key
+
+# named snapshots of one project, stored content addressed so unchanged directories are shared
+#
+#   objects/<id[:2]>/<id[2:]> : one directory, id is the sha256 of its bytes
+#   snapshots/<name>.json     : path, hash algorithm, checksum width, root object, created time
+#
+# directory object (little-endian), files first then sub directories, both sorted by name
+#
+#   entry : kind(u8) name_length(varint) name(utf-8) checksum(checksum_width)
+#           [files only] size(u64) mtime_ns(i64) inode(u64) device(u64)
+#           [directories only] object_id(32) descendants(varint)
+OBJECT_ID_BYTES = 32
+
+class DirectoryEntry(NamedTuple):
+    name: str
+    is_dir: bool
+    checksum: int
+    stat: Optional[StatKey] = None
+    object_id: Optional[str] = None
+    descendants: int = 0
+
+def encode_directory(entries: list[DirectoryEntry], checksum_width: int) -> bytes:
+    data = bytearray()
+    for entry in entries:
+        name = encode_path(entry.name)
+        data.append(KIND_DIRECTORY if entry.is_dir else KIND_FILE)
+        data += encode_varint(len(name)) + name
+        data += entry.checksum.to_bytes(checksum_width, 'little')
+        if entry.is_dir:
+            data += bytes.fromhex(entry.object_id) + encode_varint(entry.descendants)
+        else:
+            data += SNAPSHOT_STAT.pack(*entry.stat)
+
+    return bytes(data)
+
+def decode_directory(data: bytes, checksum_width: int) -> list[DirectoryEntry]:
+    entries = []
+    offset = 0
+    while offset < len(data):
+        is_dir = data[offset] == KIND_DIRECTORY
+        length, offset = decode_varint(data, offset + 1)
+        name = decode_path(data[offset:offset + length])
+        offset += length
+        checksum = int.from_bytes(data[offset:offset + checksum_width], 'little')
+        offset += checksum_width
+
+        if is_dir:
+            object_id = data[offset:offset + OBJECT_ID_BYTES].hex()
+            descendants, offset = decode_varint(data, offset + OBJECT_ID_BYTES)
+            entries.append(DirectoryEntry(name, True, checksum, None, object_id, descendants))
+        else:
+            entries.append(DirectoryEntry(name, False, checksum, SNAPSHOT_STAT.unpack_from(data, offset)))
+            offset += SNAPSHOT_STAT.size
+
+    return entries
+
+def child_path(directory: str, entry: DirectoryEntry) -> str:
+    # same path forms as the scan: os.path.join for directories, Path for files
+    return os.path.join(directory, entry.name) if entry.is_dir else str(Path(directory).joinpath(entry.name))
+
+class StoredSnapshot(NamedTuple):
+    name: str
+    path: str
+    hash_algorithm: int
+    checksum_width: int
+    root: DirectoryEntry
+    created_at: float
+
+class ObjectStore:
+    def __init__(self: Self, path: Path) -> None:
+        self.path = Path(path)
+        self.objects_path = self.path.joinpath('objects')
+        self.snapshots_path = self.path.joinpath('snapshots')
+
+    def object_path(self: Self, object_id: str) -> Path:
+        return self.objects_path.joinpath(object_id[:2], object_id[2:])
+
+    def put(self: Self, data: bytes) -> tuple[str, bool]:
+        # returns the object id and whether the object was new
+        object_id = sha256(data).hexdigest()
+        object_path = self.object_path(object_id)
+        if object_path.exists():
+            return object_id, False
+
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = object_path.with_name(object_path.name + '.tmp')
+        temporary_path.write_bytes(data)
+        os.replace(temporary_path, object_path)
+        return object_id, True
+
+    def get(self: Self, object_id: str) -> bytes:
+        return self.object_path(object_id).read_bytes()
+
+    def children(self: Self, entry: DirectoryEntry, checksum_width: int) -> list[DirectoryEntry]:
+        return decode_directory(self.get(entry.object_id), checksum_width)
+
+    def subtree(self: Self, entry: DirectoryEntry, path: str, checksum_width: int) -> Iterator[Record]:
+        # the records below and of one directory, in the record_key order of the snapshot file
+        if not entry.is_dir:
+            yield Record(path, False, entry.checksum, entry.stat)
+            return
+
+        for child in self.children(entry, checksum_width):
+            yield from self.subtree(child, child_path(path, child), checksum_width)
+
+        yield Record(path, True, entry.checksum, None, entry.descendants)
+
+    def writer(self: Self, root: str, checksum_width: int) -> 'TreeWriter':
+        return TreeWriter(self, root, checksum_width)
+
+    def snapshot_path(self: Self, name: str) -> Path:
+        return self.snapshots_path.joinpath(f"{name}.json")
+
+    def save(self: Self, snapshot: StoredSnapshot) -> None:
+        self.snapshots_path.mkdir(parents=True, exist_ok=True)
+        snapshot_path = self.snapshot_path(snapshot.name)
+        temporary_path = snapshot_path.with_name(snapshot_path.name + '.tmp')
+        temporary_path.write_text(json.dumps({
+            'path'          : snapshot.path,
+            'hash_algorithm': snapshot.hash_algorithm,
+            'checksum_width': snapshot.checksum_width,
+            'root'          : snapshot.root.object_id,
+            'checksum'      : snapshot.root.checksum,
+            'descendants'   : snapshot.root.descendants,
+            'created_at'    : snapshot.created_at,
+        }, indent=4))
+        os.replace(temporary_path, snapshot_path)
+
+    def load(self: Self, name: str) -> StoredSnapshot:
+        data = json.loads(self.snapshot_path(name).read_text())
+        root = DirectoryEntry(entry_name(data['path']), True, data['checksum'], None, data['root'], data['descendants'])
+        return StoredSnapshot(name, data['path'], data['hash_algorithm'], data['checksum_width'], root, data['created_at'])
+
+    def names(self: Self) -> list[str]:
+        if not self.snapshots_path.exists():
+            return []
+        return sorted(path.stem for path in self.snapshots_path.glob('*.json'))
+
+    def usage(self: Self) -> tuple[int, int]:
+        # (object count, bytes) of every stored directory object
+        sizes = [path.stat().st_size for path in self.objects_path.glob('*/*')] if self.objects_path.exists() else []
+        return len(sizes), sum(sizes)
+
+class TreeWriter:
+    # builds the directory objects from records in record_key order: every directory record
+    # comes after all of its children, so it can be stored as soon as it arrives
+    def __init__(self: Self, store: ObjectStore, root: str, checksum_width: int) -> None:
+        self.store = store
+        self.root = root
+        self.checksum_width = checksum_width
+        self.frames: dict[str, list[DirectoryEntry]] = {}
+        self.root_entry: Optional[DirectoryEntry] = None
+        self.objects = 0
+        self.new_objects = 0
+
+    def add(self: Self, record: Record) -> None:
+        key = os.path.normpath(record.path)
+
+        if record.is_dir:
+            data = encode_directory(self.frames.pop(key, []), self.checksum_width)
+            object_id, is_new = self.store.put(data)
+            self.objects += 1
+            self.new_objects += is_new
+            entry = DirectoryEntry(entry_name(record.path), True, record.checksum, None, object_id, record.descendants)
+        else:
+            entry = DirectoryEntry(entry_name(record.path), False, record.checksum, record.stat)
+
+        if key == os.path.normpath(self.root):
+            self.root_entry = entry
+        else:
+            self.frames.setdefault(parent_key(key), []).append(entry)
+
+    def close(self: Self, name: str, hash_algorithm: int) -> StoredSnapshot:
+        snapshot = StoredSnapshot(name, self.root, hash_algorithm, self.checksum_width, self.root_entry, time.time())
+        self.store.save(snapshot)
+        return snapshot